@@ -17,10 +17,23 @@
 # ##### END GPL LICENSE BLOCK #####
 
 
+import array
+import bisect
+import collections
 import csv
+import fnmatch
+import functools
+import hashlib
+import heapq
+import itertools
+import json
+import operator
 import os
+import pickle
+import re
 import threading
 import time
+import types
 
 import bpy
 
@@ -31,9 +44,25 @@ import bpy
 
 # Configuration
 CHECK_INTERVAL = 5 # time in seconds
+MIN_CHECK_INTERVAL = 1 # interval right after new operators ran
+MAX_CHECK_INTERVAL = 60 # longest interval backed off to while user is idle
+MAX_DUTY = 0.01 # max fraction of wall time checks may take
+DEADLINE_SLACK = 0.05 # time in seconds to wait past an elapsed deadline
 SCENE_POPUP_INTERVAL = 7 # min time in seconds before allowing another popup to generate
 LAST_N_ACTIONS = 20 # cache of last number of operators/prop changes to check
 VERBOSE = False # extra printouts
+CAPTURE_BUDGET = 0.0005 # max time in seconds for main thread snapshot capture
+BANK_CACHE_VERSION = 8 # increment when compiled rule classes change
+HEADER_BLINK = 0.5 # time in seconds between header icon blinks
+DISMISSED_LOG = "dismissed.log" # append-only log of dismissed ids, in config folder
+DISMISSED_COMPACT_SLACK = 32 # extra duplicate log lines allowed before compacting
+PROFILE_SAMPLES = 512 # latest durations kept per timed section
+PROFILE_DUMP = "profile.json" # performance stats dump, in config folder
+BANK_CACHE = "suggestions_cache" # folder of compiled rules per tsv hash, in config folder
+PACKS_FOLDER = "packs" # default folder of extra suggestion packs, in config folder
+PACK_POLL_INTERVAL = 2 # time in seconds between checks for edited packs
+LOAD_CHUNK_ROWS = 256 # tsv rows parsed between yielding to the main thread
+NAME_LOG_SIZE = 256 # latest added or removed names kept by each name index
 
 # global state saving with appropriate initial values
 LAST_CHECK = 0 # last check for suggestions
@@ -41,17 +70,105 @@ UI_LAST_CHECK = 0
 #LAST_POPUP_TIME = 0
 BACKGROUND_THREAD = None # registration of the background thread object
 STOP_SERVER = False # global message used to stop background thread
+WAKE_EVENT = threading.Event() # set when a new snapshot is ready to evaluate
+SNAPSHOT = None # immutable facts captured on the main thread for evaluation
+SNAPSHOT_CHANGES = None # keys changed by captures since the worker took SNAPSHOT, None for all
+LAST_CAPTURE_TIME = 0 # duration in seconds of the last snapshot capture
+LAST_EVAL_TIME = 0 # duration in seconds of the last background evaluation
+NEXT_INTERVAL = CHECK_INTERVAL # adaptive interval, see schedule_next_check
+SCENE_ACTIVITY = False # whether scene updates happened since the last check
+SUSPENDED = set() # reasons checks are suspended, e.g. render or playback
+HEADER_STATE = ('MONKEY', 0) # header icon and version, only thing header draw reads
+POPUP_READY = False # whether the popup handler should show SUGGESTIONS now
+POPUP_HANDLER = None # scene update handler showing popups, set by assistant_ui
 SUGGESTION_BANK = [] # list of template suggestions
+PACKS = {} # tsv path to (signature, hash, compiled rules) of each loaded pack
+PACK_SIGNATURES = None # (path, signature) of loaded packs in merge order, None until loaded
+PACKS_DIR = None # folder of extra suggestion packs, see get_packs_folder
+PACKS_CHANGED = False # set by pack_watch_timer to reload packs in the background
+PACKS_RELOADED = False # set once reloaded packs are published, for pack_watch_timer to request a check
+BANK_DIAGNOSTICS = [] # "file:line: problem" of each tsv row skipped while loading
+BANK_LOCK = threading.Lock() # held while publishing a bank and capturing snapshots
+COMPILED_RULES = [] # list of (suggestion, predicates) tuples, highest priority first
+DEPENDENCY_INDEX = {} # input source key to set of COMPILED_RULES indices reading it
+SOURCE_KEYS = {} # input source to the DEPENDENCY_INDEX keys read from it, see key_source
+CAPTURED_INDEX = None # DEPENDENCY_INDEX of the last capture, all keys are read after a publish
+CAPTURED_VERSIONS = {} # input source to its version as of the last capture, see source_version
+CAPTURED_PATTERNS = {} # datablock kind to the wildcard keys of CAPTURED_INDEX, see renamed_keys
+RULE_VIEWS = {} # (helpful only, category) to rule view of the rules it shows, see build_views
+VIEW_KEY = (False, None) # key of the rule view picked in preferences
+EMPTY_VIEW = ({}, None) # rule view showing no rules, e.g. for an unknown category
+RULE_GROUPS = [] # COMPILED_RULES index to the RuleGroups of all views showing it
+RULE_INDICES = {} # suggestion id to its COMPILED_RULES indices, for hiding dismissed rules
+HIDDEN_RULES = set() # indices of dismissed rules, left out of all RuleGroups
+HIDDEN_VERSION = None # DISMISSED_VERSION which HIDDEN_RULES reflects
+ACTIVE_VIEW = EMPTY_VIEW # rule view of VIEW_KEY, swapped in whole when the preference changes
+PROP_TREE = {} # prefix tree of all prop paths in DEPENDENCY_INDEX, see build_prop_tree
+ELAPSED_THRESHOLDS = [] # sorted distinct seconds of all elapsed conditions
+LAST_FACTS = {} # input source values as read in the previous check
+MATCHING_RULES = set() # cached indices of rules whose conditions were met
+PENDING_RULES = set() # indices of rules whose cached verdict is out of date
 SUGGESTIONS = {} # dict of details for active suggestion
-OPS_SEQUENCE = [] # list of recent operators, last entry is most recent run
+OPS_SEQUENCE = collections.deque(maxlen=LAST_N_ACTIONS) # recent operators, last entry is most recent run
+OPS_CURSOR = None # pointer of the newest operator captured into OPS_SEQUENCE
+OPS_AUTOMATON = None # OpsSequenceAutomaton matching all ops_seq conditions
 PREVIOUS_SUGGESTION = None # csv id text of previous suggestion, for state tracking
 PREVIOUS_POPUP = None # to help 'debounce' popup UIs
-DISMISSED = {} # all suggestions that have been dismissed
+DISMISSED = {} # all suggestions that have been dismissed, to whether saved to disk
+DISMISSED_VERSION = 0 # incremented on every change of DISMISSED
+DISMISSED_LOADED = False # whether the dismissed log was loaded into DISMISSED
+DISMISSED_PENDING = [] # ids to append to the dismissed log, None to truncate it
+DISMISSED_LOCK = threading.Lock() # guards DISMISSED and DISMISSED_PENDING across threads
+DISMISSED_LOG_LINES = 0 # lines in the dismissed log, to decide on compaction
+SCENE_FACTS = {} # cached object count, type counts and names, see get_scene_facts
+SCENE_FACTS_DIRTY = True # set when depsgraph updates can't be applied to SCENE_FACTS, e.g. removals
+SCENE_OBJECTS = {} # pointer of each object counted in SCENE_FACTS to its type
+SCENE_FACTS_VERSION = 0 # incremented on every change of SCENE_FACTS
+COUNTS_STALE = False # set by depsgraph updates which may have removed datablocks, see refresh_scene_facts
+NAMES_DIRTY = False # set when depsgraph updates can't be applied to NAME_INDEXES, e.g. removals
+NAME_INDEXES = {} # datablock kind to NameIndex, kept in sync with SCENE_FACTS
+PROFILE = False # whether timings are recorded, see set_profiling
+PROFILE_TIMINGS = {} # timed section name to TimingRing
+RULE_TIMINGS = array.array('q') # summed ns spent testing each COMPILED_RULES index
+RULE_EVALS = array.array('q') # number of evaluations of each COMPILED_RULES index
+CONDITION_TIMINGS = {} # condition class name to [summed ns, number of tests]
+
+# name conditions, mapped to datablock kind and whether they are negated
+EXISTS_CONDITIONS = {
+	"object_exists": ("object", False),
+	"no_object_exists": ("object", True),
+	"collection_exists": ("collection", False),
+	"no_collection_exists": ("collection", True),
+	"material_exists": ("material", False),
+	"no_material_exists": ("material", True)
+}
+# bpy.data attributes holding each datablock kind, first found is used
+NAME_INDEX_DATA = {
+	"object": ("objects",),
+	"collection": ("collections", "groups"), # groups pre blender 2.8
+	"material": ("materials",)
+}
+# datablocks other than objects whose updates may add, remove or rename names
+STRUCTURAL_TYPES = tuple(getattr(bpy.types, name)
+	for name in ("Scene", "Collection", "Material") if hasattr(bpy.types, name))
+# bpy.types of each datablock kind, to apply updates to its name index
+NAME_INDEX_TYPES = tuple((kind, getattr(bpy.types, name))
+	for kind, name in (("object", "Object"), ("collection", "Collection"),
+		("material", "Material")) if hasattr(bpy.types, name))
+GLOB_CHARS = re.compile(r"[*?[]") # start of wildcards in name patterns
+MISSING_PROPS = set() # prop paths which don't exist in this blender version
 
 # actions to ignore when looking back at recent user driven changes
 IGNORE_ACTIONS = ["Warning:", "bpy.ops.object.select_all",
 	"bpy.context.area.type =", "bpy.context.space_data.context =",
 	"bpy.ops.object.location_clear", "bpy.ops.assist.suggestion_action"]
+IGNORE_FILTER = None # single compiled regex matching any ignored action
+REQUIRED_COLUMNS = ("id", "condition", "suggestion", "buttons", "action")
+BUTTONS = ("ok", "dismiss", "none") # comma separated values of the buttons column
+DISABLE_MARKER = "DISABLE_ROW" # condition marking a row as disabled, skipped without error
+FLAGS = ("", "TRUE", "FALSE") # values of the helpful column, in any case
+OPS_ACTION = re.compile(r"[A-Za-z_]\w*\.[A-Za-z_]\w*$") # operator of ops: actions
+IGNORE_FILTER_KEY = None # ignore entries IGNORE_FILTER was compiled from
 
 # -----------------------------------------------------------------------------
 # Compatibility functions
@@ -64,6 +181,15 @@ def log(statement):
 		print("[assistant] "+str(statement))
 
 
+def clock_ns():
+	"""Fallback for time.perf_counter_ns, only in python 3.7 (blender 2.80)+"""
+	return int(time.perf_counter()*1e9)
+
+
+if hasattr(time, "perf_counter_ns"):
+	clock_ns = time.perf_counter_ns
+
+
 def make_annotations(cls):
 	"""Add annotation attribute to class fields to avoid Blender 2.8 warnings"""
 	if not hasattr(bpy.app, "version") or bpy.app.version < (2, 80):
@@ -129,141 +255,1061 @@ def ui_scale():
 # -----------------------------------------------------------------------------
 
 
-def load_suggestions():
-	"""Load (and rename from update) the tab-delimited suggestions file"""
-	global SUGGESTION_BANK
+def get_config_path(filename):
+	"""Returns path of a file in the addon config folder, None if unavailable"""
+	if not hasattr(bpy.utils, "user_resource"):
+		return None
+	# create the folder here, as the keyword for that is autocreate before
+	# blender 3.0 and create after
+	folder = bpy.utils.user_resource('CONFIG', path="suzanne_assistant")
+	if not folder:
+		return None
+	try:
+		os.makedirs(folder, exist_ok=True)
+	except OSError as err:
+		log("Could not create addon config folder: "+str(err))
+		return None
+	return os.path.join(folder, filename)
+
+
+def load_bank_cache(folder, digest):
+	"""Returns cached (rules, diagnostics) if built from a tsv of this hash"""
+	if not folder:
+		return None
+	path = os.path.join(folder, digest+".pickle")
+	if not os.path.isfile(path):
+		return None
+	try:
+		with open(path, mode='rb') as infile:
+			cache = pickle.load(infile)
+	except Exception as err:
+		log("Could not read bank cache, rebuilding: "+str(err))
+		return None
+	if cache.get("version") != BANK_CACHE_VERSION:
+		return None
+	return cache["rules"], cache["diagnostics"]
+
+
+def save_bank_cache(folder, digest, rules, diagnostics):
+	"""Save compiled rules of a tsv for a quick load, keyed by its hash"""
+	if not folder:
+		return
+	path = os.path.join(folder, digest+".pickle")
+	cache = {"version": BANK_CACHE_VERSION, "rules": rules,
+		"diagnostics": diagnostics}
+	try:
+		if not os.path.isdir(folder):
+			os.makedirs(folder)
+		with open(path+".tmp", mode='wb') as outfile:
+			pickle.dump(cache, outfile, protocol=pickle.HIGHEST_PROTOCOL)
+		os.replace(path+".tmp", path)
+	except Exception as err:
+		log("Could not write bank cache: "+str(err))
+
+
+def prune_bank_cache(folder, digests):
+	"""Remove cached compiled rules of tsv files no longer loaded"""
+	if not folder or not os.path.isdir(folder):
+		return
+	for name in os.listdir(folder):
+		if name.endswith(".pickle") and name[:-7] not in digests:
+			try:
+				os.remove(os.path.join(folder, name))
+			except OSError as err:
+				log("Could not remove stale bank cache: "+str(err))
+
+
+def parse_priority(value):
+	"""Returns the priority column as int, 0 if empty or missing"""
+	if value is None or not value.strip():
+		return 0
+	try:
+		return int(value)
+	except ValueError:
+		raise ValueError("Priority is not a whole number: "+value)
+
+
+def validate_buttons(buttons):
+	"""Raise ValueError if the buttons column has unknown buttons"""
+	for button in buttons.split(","):
+		if button and button not in BUTTONS:
+			raise ValueError("Button not recognized: "+button)
+
+
+def validate_action(action):
+	"""Raise ValueError if the action column has unknown or malformed actions.
+
+	Follows what ASSIST_OT_assistant_suggestion_action can run: space
+	separated url:, ops: and prop: actions, trigger_followup or none.
+	"""
+	for act in action.split(" "):
+		if act in ("", "none", "trigger_followup"):
+			continue
+		kind, _, value = act.partition(":")
+		kind = kind.lower()
+		if kind == "url" and value:
+			continue
+		elif kind == "ops" and OPS_ACTION.match(value):
+			continue
+		elif kind == "prop" and value.find("=") > 0:
+			interpret_value(value[1+value.index("="):])
+			continue
+		raise ValueError("Action not recognized: "+act)
+
+
+def parse_suggestions(lines, source="suggestions.tsv"):
+	"""Stream, validate and compile tsv lines into (suggestion, predicates).
+
+	Lines can be an open file, which is then read row by row. Returns the
+	rules and diagnostics, one "source:line: problem" for each row skipped
+	for a wrong number of columns or an invalid condition, buttons, action,
+	helpful flag or priority. Rows with a DISABLE_ROW condition are skipped
+	without a diagnostic. Rules are sorted by descending priority, keeping file order
+	among rules of the same priority, so the first matching rule is the one
+	to show.
+	"""
+	reader = csv.reader(lines, delimiter='\t')
+	header = next(reader, None)
+	if header is None:
+		return [], ["{}: file is empty".format(source)]
+	missing = [col for col in REQUIRED_COLUMNS if col not in header]
+	if missing:
+		return [], ["{}:{}: missing columns: {}".format(
+			source, reader.line_num, ", ".join(missing))]
+
+	rules = []
+	diagnostics = []
+	for row in reader:
+		if not row:
+			continue # blank line
+		try:
+			if len(row) != len(header):
+				raise ValueError("Expected {} columns, found {}".format(
+					len(header), len(row)))
+			entry = dict(zip(header, row))
+			if not entry["id"]:
+				raise ValueError("Missing id")
+			if DISABLE_MARKER in entry["condition"].split(" "):
+				continue # kept in the file, but deliberately not loaded
+			predicates = compile_conditions(entry["condition"])
+			validate_buttons(entry["buttons"])
+			validate_action(entry["action"])
+			if entry.get("helpful", "").upper() not in FLAGS:
+				raise ValueError("Helpful is not TRUE or FALSE: "+entry["helpful"])
+			priority = parse_priority(entry.get("priority"))
+		except ValueError as err:
+			diagnostics.append("{}:{}: {}".format(source, reader.line_num, err))
+			continue
+		rules.append((-priority, len(rules), (entry, predicates)))
+		if len(rules) % LOAD_CHUNK_ROWS == 0:
+			time.sleep(0) # let the main thread have the GIL between chunks
+	rules.sort(key=operator.itemgetter(0, 1))
+	return [rule for _, _, rule in rules], diagnostics
+
+
+def hash_file(path):
+	"""Returns the sha1 hex digest of a file, read in chunks"""
+	digest = hashlib.sha1()
+	with open(path, mode='rb') as infile:
+		for chunk in iter(functools.partial(infile.read, 1 << 16), b""):
+			digest.update(chunk)
+	return digest.hexdigest()
+
+
+def load_pack(path, signature, cache_folder):
+	"""Returns (signature, hash, rules, diagnostics) of a tsv, and if parsed.
+
+	Compiled from the bank cache if there, otherwise streamed from the file
+	and cached, unless the file changed again while it was parsed.
+	"""
+	digest = hash_file(path)
+	cached = load_bank_cache(cache_folder, digest)
+	if cached is not None:
+		return (signature, digest) + cached, False
+	with open(path, mode='r', newline='', encoding="utf-8", errors="replace") as infile:
+		rules, diagnostics = parse_suggestions(infile, os.path.basename(path))
+	if get_pack_signatures([path]) == ((path, signature),):
+		save_bank_cache(cache_folder, digest, rules, diagnostics)
+	return (signature, digest, rules, diagnostics), True
+
+
+def get_packs_folder(prefs=None):
+	"""Returns the folder of extra suggestion packs, set in preferences or default"""
+	if prefs and prefs.packs_folder:
+		return os.path.expanduser(prefs.packs_folder)
+	return get_config_path(PACKS_FOLDER)
+
+
+def get_pack_paths():
+	"""Returns the addon suggestions file then all tsv packs, in merge order"""
+	paths = []
+	base = os.path.join(os.path.dirname(__file__), "suggestions.tsv")
+	if os.path.isfile(base):
+		paths.append(base)
+	folder = PACKS_DIR
+	if folder and os.path.isdir(folder):
+		paths.extend(sorted(os.path.join(folder, name)
+			for name in os.listdir(folder) if name.lower().endswith(".tsv")))
+	return paths
+
+
+def get_pack_signatures(paths):
+	"""Returns (path, (mtime, size)) of each existing path, to detect edits"""
+	signatures = []
+	for path in paths:
+		try:
+			stat = os.stat(path)
+		except OSError:
+			continue
+		signatures.append((path, (stat.st_mtime_ns, stat.st_size)))
+	return tuple(signatures)
+
+
+def load_suggestions(paths=None):
+	"""Load (and rename from update) the suggestions file and suggestion packs.
+
+	Packs are tab-delimited files just like the suggestions file, merged by
+	id so rows of later packs replace those of earlier ones. Only files which
+	changed since the last load are read and compiled again, the compiled
+	rules of the others are reused as is. Compiled rules are also cached on
+	disk keyed by the hash of each file, so unchanged files load with a single
+	read and no parsing. A list of tsv paths can be given to load instead of
+	the addon's own, e.g. for benchmarks.
+
+	Run on the background thread, the new bank is only published once fully
+	loaded, see publish_rules.
+	"""
+	global PACKS
+	global PACK_SIGNATURES
+
+	start = time.perf_counter()
 
 	# overwrite/rename updated suggestion file to final format
-	tsv_update = os.path.join(os.path.dirname(__file__), "suggestions_update.tsv")
-	tsv = os.path.join(os.path.dirname(__file__), "suggestions.tsv")
-	if os.path.isfile(tsv_update):
-		if os.path.isfile(tsv):
-			os.remove(tsv)
-		os.rename(tsv_update, tsv)
-	if not os.path.isfile(tsv):
+	if paths is None:
+		tsv_update = os.path.join(os.path.dirname(__file__), "suggestions_update.tsv")
+		tsv = os.path.join(os.path.dirname(__file__), "suggestions.tsv")
+		if os.path.isfile(tsv_update):
+			if os.path.isfile(tsv):
+				os.remove(tsv)
+			os.rename(tsv_update, tsv)
+		paths = get_pack_paths()
+	signatures = get_pack_signatures(paths)
+	if not signatures:
 		log("Suggestions file not found")
 		return
+	if signatures == PACK_SIGNATURES:
+		return
 
-	# load csv with tab delineation (tsv) into dictionary format
-	suggestion = []
-	with open(tsv, mode='r') as infile:
-		lines = infile.readlines()
-		reader = csv.DictReader(lines, delimiter='\t')
-		for entry in reader:
-			suggestion.append(entry)
-
-	# pivot from item in single row in list, to key for that dict within dict
-	SUGGESTION_BANK = suggestion # {itm['id']:itm for itm in suggestion}
-	log("Found {} suggestions from tsv file".format(len(SUGGESTION_BANK)))
+	cache_folder = get_config_path(BANK_CACHE)
+	packs = {}
+	loaded = []
+	parsed = 0
+	for path, signature in signatures:
+		pack = PACKS.get(path)
+		if pack is None or pack[0] != signature:
+			try:
+				pack, was_parsed = load_pack(path, signature, cache_folder)
+				parsed += was_parsed
+			except OSError as err:
+				log("Could not read suggestion pack: "+str(err))
+				if pack is None:
+					continue
+				signature = pack[0] # keep old rules, retried on next poll
+		packs[path] = pack
+		loaded.append((path, signature))
+	PACKS = packs
+	PACK_SIGNATURES = tuple(loaded)
+	if parsed:
+		prune_bank_cache(cache_folder, set(pack[1] for pack in packs.values()))
+
+	publish_rules(merge_packs([packs[path][2] for path, _ in loaded]),
+		[diagnostic for path, _ in loaded for diagnostic in packs[path][3]])
+	for diagnostic in BANK_DIAGNOSTICS:
+		log("Skipped suggestion, "+diagnostic)
+	log("Found {} suggestions in {} files, {} parsed, in {:.1f}ms".format(
+		len(SUGGESTION_BANK), len(loaded), parsed,
+		(time.perf_counter()-start)*1000))
+
+
+def merge_packs(packs):
+	"""Combine compiled rules of packs by id, sorted by priority.
+
+	Rows of a pack replace all rows with the same id from earlier packs, while
+	rows sharing an id within one pack are kept as alternatives.
+	"""
+	owner = {}
+	for n, rules in enumerate(packs):
+		for entry, _ in rules:
+			owner[entry["id"]] = n
+	merged = [rule for n, rules in enumerate(packs)
+		for rule in rules if owner[rule[0]["id"]] == n]
+	if len(packs) > 1:
+		merged.sort(key=lambda rule: -parse_priority(rule[0].get("priority")))
+	return merged
+
+
+def publish_rules(rules, diagnostics=()):
+	"""Swap in newly compiled rules along with all state derived from them.
+
+	Everything is built up front and then assigned at once under BANK_LOCK,
+	so snapshot captures never see a mix of old and new bank state. Rules
+	reused from unchanged packs are the same objects as before, so their
+	verdicts in MATCHING_RULES stay valid against LAST_FACTS and only new
+	rules need evaluating. A pending suggestion whose rule is gone is dropped.
+	"""
+	global SUGGESTIONS
+	global SUGGESTION_BANK
+	global COMPILED_RULES
+	global BANK_DIAGNOSTICS
+	global DEPENDENCY_INDEX
+	global SOURCE_KEYS
+	global SNAPSHOT_CHANGES
+	global RULE_VIEWS
+	global ACTIVE_VIEW
+	global RULE_GROUPS
+	global RULE_INDICES
+	global HIDDEN_RULES
+	global HIDDEN_VERSION
+	global PROP_TREE
+	global ELAPSED_THRESHOLDS
+	global OPS_AUTOMATON
+	global LAST_FACTS
+	global MATCHING_RULES
+	global PENDING_RULES
+
+	index, sources, prop_tree, thresholds, automaton = build_dependency_index(rules)
+	old_rules = COMPILED_RULES # keeps ids of old rules unique until mapped
+	known = {id(rule): i in MATCHING_RULES for i, rule in enumerate(old_rules)
+		if i not in PENDING_RULES}
+	pending = set(i for i, rule in enumerate(rules) if id(rule) not in known)
+	matching = set(i for i, rule in enumerate(rules) if known.get(id(rule)))
+	last_facts = LAST_FACTS if len(pending) < len(rules) else {}
+	views, groups = build_views(rules, pending, matching)
+	indices = {}
+	for i, (entry, _) in enumerate(rules):
+		indices.setdefault(entry["id"], []).append(i)
+
+	with BANK_LOCK:
+		# pivot from item in single row in list, to key for that dict within dict
+		SUGGESTION_BANK = [entry for entry, _ in rules] # {itm['id']:itm for itm in suggestion}
+		COMPILED_RULES = rules
+		BANK_DIAGNOSTICS = list(diagnostics)
+		DEPENDENCY_INDEX = index
+		SOURCE_KEYS = sources
+		SNAPSHOT_CHANGES = None # diff all keys of the next snapshot
+		RULE_VIEWS = views
+		ACTIVE_VIEW = views.get(VIEW_KEY, EMPTY_VIEW)
+		RULE_GROUPS = groups
+		RULE_INDICES = indices
+		HIDDEN_RULES = set() # hidden again on the next check, see sync_hidden_rules
+		HIDDEN_VERSION = None
+		PROP_TREE = prop_tree
+		ELAPSED_THRESHOLDS = thresholds
+		OPS_AUTOMATON = automaton
+		LAST_FACTS = last_facts
+		MATCHING_RULES = matching
+		PENDING_RULES = pending
+		if SUGGESTIONS and not any(entry is SUGGESTIONS for entry, _ in rules):
+			SUGGESTIONS = {} # e.g. its row was removed from a pack
+	log("Published {} rules reading {} input sources, {} cached verdicts kept".format(
+		len(rules), len(index), len(rules) - len(pending)))
 
 
 def start_background_thread_if_none():
-	"""Initializes the primary running background thread, to avoid UI blocks.
+	"""Starts the single long-lived background thread, to avoid UI blocks.
 
-	Note this is triggered constantly by UI redrawing, end quickly wherever
-	possible.
+	Only needed in blender versions without app timers, where this is
+	triggered constantly by scene updates to drive the snapshot capture, so
+	end quickly wherever possible.
 	"""
-	global VERBOSE
-	VERBOSE = get_addon_preferences().verbose
+	if BACKGROUND_THREAD is None and STOP_SERVER is False:
+		start_background_thread()
+	snapshot_timer()
+	icon = 'ERROR' if SUGGESTIONS else 'MONKEY' # no timers to blink with
+	if icon != HEADER_STATE[0]:
+		set_header_state(icon)
 
-	if STOP_SERVER is True:
-		return
 
+@bpy.app.handlers.persistent
+def legacy_update_handler(scene):
+	"""Scene update handler driving checks in blender versions without timers"""
+	start_background_thread_if_none()
+
+
+def set_packs_folder(folder):
+	"""Change the folder of extra suggestion packs, picked up by the next poll"""
+	global PACKS_DIR
+	PACKS_DIR = folder
+
+
+def pack_watch_timer():
+	"""Idle main thread timer, polling suggestion packs for edits.
+
+	Only stats the files, reloading of changed packs is left to the
+	background thread. Once reloaded, a check is requested right away so the
+	edits show without waiting for the next, possibly backed off, check.
+	"""
+	global PACKS_CHANGED
+	global PACKS_RELOADED
+	if STOP_SERVER is True:
+		return None
+	if PACKS_RELOADED:
+		PACKS_RELOADED = False
+		request_check()
+	if PACK_SIGNATURES is None or PACKS_CHANGED or SUSPENDED:
+		return PACK_POLL_INTERVAL
+	if get_pack_signatures(get_pack_paths()) != PACK_SIGNATURES:
+		log("Suggestion packs changed, reloading")
+		PACKS_CHANGED = True
+		WAKE_EVENT.set()
+	return PACK_POLL_INTERVAL
+
+
+def start_background_thread():
+	"""Create and start the background thread evaluating snapshots"""
 	global BACKGROUND_THREAD
 	global LAST_CHECK
-	now = time.time()
-	if BACKGROUND_THREAD and BACKGROUND_THREAD.is_alive():
-		# log("Is alive.. so all good")
-		return
-	if BACKGROUND_THREAD and not BACKGROUND_THREAD.is_alive():
-		BACKGROUND_THREAD = None  # thread died/ended
-	if LAST_CHECK and now < LAST_CHECK + CHECK_INTERVAL:
-		return # interval not passed, failsafe to not constantly create threads
+	global VERBOSE
+
+	prefs = get_addon_preferences()
+	if prefs:
+		VERBOSE = prefs.verbose
+		if prefs.profile != PROFILE:
+			set_profiling(prefs.profile)
+		set_view(prefs.helpful, prefs.category.strip())
+	set_packs_folder(get_packs_folder(prefs))
 	if not LAST_CHECK:
-		LAST_CHECK = now # to prevent double execution
+		LAST_CHECK = time.time() # first check only after a full interval
 
-	log("Starting new background assistant thread")
+	log("Starting background assistant thread")
+	WAKE_EVENT.clear()
 	BACKGROUND_THREAD = threading.Thread(target=assistant_thread)
-	BACKGROUND_THREAD.daemon = True # re-uncoment?
+	BACKGROUND_THREAD.daemon = True # never keep blender from quitting
 	BACKGROUND_THREAD.start()
 
 
-def assistant_thread():
-	"""Long-running function in background thread to perform state checks"""
+def stop_background_thread(timeout=1.0):
+	"""Signal the background thread to end, and wait for it to do so"""
 	global STOP_SERVER
+	STOP_SERVER = True
+	WAKE_EVENT.set()
+	thread = BACKGROUND_THREAD
+	if thread and thread.is_alive() and thread is not threading.current_thread():
+		thread.join(timeout)
+
+
+def snapshot_timer():
+	"""Main thread timer, capturing a new snapshot once per check interval"""
 	global LAST_CHECK
-	global SUGGESTIONS
 
-	if not SUGGESTION_BANK:
-		load_suggestions()
+	if STOP_SERVER is True:
+		return None
+	# playback handlers are missing in some versions, so track it here too
+	playing = is_animation_playing()
+	if playing and "playback" not in SUSPENDED:
+		suspend_checks("playback")
+	elif not playing and "playback" in SUSPENDED:
+		resume_checks("playback")
+	if SUSPENDED:
+		return CHECK_INTERVAL # only poll the flag while rendering or playing
+	if BACKGROUND_THREAD is None:
+		start_background_thread()
+	now = time.time()
+	if now < LAST_CHECK + NEXT_INTERVAL:
+		return LAST_CHECK + NEXT_INTERVAL - now # pushed back, e.g. by a popup
+	LAST_CHECK = now
+	refresh_scene_facts(bpy.context)
+	new_ops = capture_snapshot()
+	update_popup_ready()
+	if hasattr(bpy.app, "timers") and not bpy.app.timers.is_registered(
+			header_blink_timer):
+		bpy.app.timers.register(header_blink_timer, first_interval=HEADER_BLINK)
+	return schedule_next_check(new_ops)
+
+
+def schedule_next_check(new_ops):
+	"""Returns the adaptive interval in seconds until the next check.
+
+	Tightens right after new operators ran, backs off exponentially while
+	neither operators nor scene updates happen, wakes exactly when the next
+	elapsed condition can flip, and never lets the measured cost of a check
+	exceed MAX_DUTY of the wall time.
+	"""
+	global NEXT_INTERVAL
+	global SCENE_ACTIVITY
 
-	first_live = time.time()
+	if new_ops:
+		interval = MIN_CHECK_INTERVAL
+	elif SCENE_ACTIVITY is False:
+		interval = min(max(NEXT_INTERVAL, CHECK_INTERVAL)*2, MAX_CHECK_INTERVAL)
+	else:
+		interval = CHECK_INTERVAL
+	deadline = next_elapsed_deadline()
+	if deadline is not None:
+		interval = min(interval, max(deadline - time.time(), 0) + DEADLINE_SLACK)
+	cost = LAST_CAPTURE_TIME + LAST_EVAL_TIME
+	NEXT_INTERVAL = max(interval, cost/MAX_DUTY)
+	SCENE_ACTIVITY = False
+	log("Next check in {:.1f}s".format(NEXT_INTERVAL))
+	return NEXT_INTERVAL
+
+
+def next_elapsed_deadline():
+	"""Returns the time the next elapsed condition passes, None if all have.
+
+	Elapsed conditions only count from UI_LAST_CHECK, so in between checks
+	their verdicts can only change at these deadlines.
+	"""
+	passed = bisect.bisect_right(ELAPSED_THRESHOLDS, time.time() - UI_LAST_CHECK)
+	if passed < len(ELAPSED_THRESHOLDS):
+		return UI_LAST_CHECK + ELAPSED_THRESHOLDS[passed]
+	return None
 
-	# primary never ending loop
-	while STOP_SERVER is False:
-		now = time.time()
-		if LAST_CHECK and now < LAST_CHECK + CHECK_INTERVAL:
-			time.sleep(LAST_CHECK + CHECK_INTERVAL - now)
 
-		LAST_CHECK = time.time()
-		log("Checking now for suggetions, Thread first alive:"+str(first_live))
-		update_ops_sequence()
+def is_animation_playing():
+	"""Whether animation playback is running in any window"""
+	wm = bpy.context.window_manager
+	if wm is None:
+		return False
+	for window in wm.windows:
+		if window.screen and window.screen.is_animation_playing:
+			return True
+	return False
 
-		generate_suggestions()
 
-		# temporary override to execute once
-		# TODO: in future, use signals or others so that a single ongoing
-		# living thread won't hang blender on quit if not deliberatly stopped
-		break
+def suspend_checks(reason):
+	"""Stop all checks and scene tracking, e.g. while rendering"""
+	SUSPENDED.add(reason)
 
-	log("Stopping assistant thread\n")
-	global BACKGROUND_THREAD
-	BACKGROUND_THREAD = None
 
+def resume_checks(reason):
+	"""Resume checks once nothing suspends them anymore"""
+	global SCENE_FACTS_DIRTY
+	SUSPENDED.discard(reason)
+	SCENE_FACTS_DIRTY = True # scene updates were ignored while suspended
 
-def update_ops_sequence():
-	"""Gets the most recent operators ran using text util (slightly hacky)"""
-	global OPS_SEQUENCE
-
-	# generate text block of recent actions (operators & prop changes)
-	text_list = list(bpy.data.texts)
-	res = bpy.ops.ui.reports_to_textblock()
-	if res != {'FINISHED'}:
-		OPS_SEQUENCE = []
+
+@bpy.app.handlers.persistent
+def render_init_handler(*args):
+	suspend_checks("render")
+
+
+@bpy.app.handlers.persistent
+def render_end_handler(*args):
+	resume_checks("render")
+
+
+@bpy.app.handlers.persistent
+def playback_pre_handler(*args):
+	suspend_checks("playback")
+
+
+@bpy.app.handlers.persistent
+def playback_post_handler(*args):
+	resume_checks("playback")
+
+
+# handler list names and functions suspending checks, where available
+SUSPEND_HANDLERS = (
+	("render_init", render_init_handler),
+	("render_complete", render_end_handler),
+	("render_cancel", render_end_handler),
+	("animation_playback_pre", playback_pre_handler),
+	("animation_playback_post", playback_post_handler)
+)
+
+
+def get_update_handlers():
+	"""Returns handler list ran on scene updates, in 2.7 and 2.8 friendly way"""
+	if hasattr(bpy.app.handlers, "depsgraph_update_post"):
+		return bpy.app.handlers.depsgraph_update_post
+	return bpy.app.handlers.scene_update_post
+
+
+def update_popup_ready():
+	"""Precompute whether the current suggestion should be shown as a popup.
+
+	Runs on the main thread from timers, so the constantly triggered popup
+	handler only needs to check POPUP_READY, and is only attached while set.
+	"""
+	global POPUP_READY
+	sugg = SUGGESTIONS
+	prefs = get_addon_preferences()
+	POPUP_READY = bool(sugg) \
+		and not (prefs and prefs.passive) \
+		and sugg["id"] not in DISMISSED \
+		and sugg["id"] != PREVIOUS_POPUP \
+		and time.time() >= SCENE_POPUP_INTERVAL + UI_LAST_CHECK
+	sync_popup_handler()
+
+
+def sync_popup_handler():
+	"""Attach the popup handler while a popup is ready, detach it otherwise"""
+	if POPUP_HANDLER is None:
 		return
-	new_text_list = list(bpy.data.texts)
-	new_texts = list(set(new_text_list) - set(text_list))
-	if not new_texts:
-		log("Error getting new text list for ops")
-	OPS_SEQUENCE = []
-
-	# copy the last 10 actions
-	for line in reversed(new_texts[0].lines):
-		if not line.body:
-			continue
-		for itm in IGNORE_ACTIONS:
-			if itm in line.body:
+	handlers = get_update_handlers()
+	attached = POPUP_HANDLER in handlers
+	if POPUP_READY and not attached:
+		handlers.append(POPUP_HANDLER)
+	elif not POPUP_READY and attached:
+		handlers.remove(POPUP_HANDLER)
+
+
+@bpy.app.handlers.persistent
+def scene_facts_handler(scene, depsgraph=None):
+	"""Scene update handler flagging scene activity and facts for recompute"""
+	global SCENE_ACTIVITY
+	if SUSPENDED:
+		return
+	if is_animation_playing():
+		suspend_checks("playback") # until snapshot_timer sees it stopped
+		return
+	if PROFILE:
+		start = clock_ns()
+	SCENE_ACTIVITY = True
+	if SCENE_FACTS_DIRTY is False:
+		mark_scene_facts_dirty(depsgraph)
+	if PROFILE:
+		record_timing("scene_facts_handler", clock_ns() - start)
+
+
+def set_header_state(icon):
+	"""Update the icon shown in headers and tag header regions for redraw"""
+	global HEADER_STATE
+	HEADER_STATE = (icon, HEADER_STATE[1]+1)
+	wm = bpy.context.window_manager
+	if wm is None:
+		return
+	for window in wm.windows:
+		for area in window.screen.areas:
+			if area.type not in {'INFO', 'TOPBAR'}:
 				continue
-		OPS_SEQUENCE.append(line.body)
-		if len(OPS_SEQUENCE) >= LAST_N_ACTIONS:
-			break
+			for region in area.regions:
+				if region.type == 'HEADER':
+					region.tag_redraw()
+
+
+def header_blink_timer():
+	"""Main thread timer, blinking the header icon while a suggestion is pending
+
+	Started after each snapshot capture and ends itself once no suggestion
+	is pending anymore, so it doesn't run at all while idle. Also flags when
+	the pending suggestion is ready to show as a popup.
+	"""
+	update_popup_ready()
+	if SUGGESTIONS and STOP_SERVER is False:
+		set_header_state('ERROR' if HEADER_STATE[0] == 'MONKEY' else 'MONKEY')
+		return HEADER_BLINK
+	if HEADER_STATE[0] != 'MONKEY':
+		set_header_state('MONKEY')
+	return None
+
+
+def request_check():
+	"""Capture and evaluate a new snapshot as soon as possible"""
+	global LAST_CHECK
+	global NEXT_INTERVAL
+	LAST_CHECK = 0
+	NEXT_INTERVAL = MIN_CHECK_INTERVAL
+	if hasattr(bpy.app, "timers") and STOP_SERVER is False:
+		if bpy.app.timers.is_registered(snapshot_timer):
+			bpy.app.timers.unregister(snapshot_timer)
+		bpy.app.timers.register(snapshot_timer, first_interval=0, persistent=True)
+
+
+def reschedule_check():
+	"""Wake the next check by the next elapsed deadline, after UI_LAST_CHECK moved.
+
+	Deadlines are otherwise only computed when a check runs, so a backed off
+	timer could fire long after an elapsed condition passed.
+	"""
+	global NEXT_INTERVAL
+	deadline = next_elapsed_deadline()
+	if deadline is None or STOP_SERVER is True or not hasattr(bpy.app, "timers"):
+		return
+	wake = deadline + DEADLINE_SLACK
+	if wake >= LAST_CHECK + NEXT_INTERVAL:
+		return # already checking by then
+	NEXT_INTERVAL = max(wake - LAST_CHECK, 0)
+	if bpy.app.timers.is_registered(snapshot_timer):
+		bpy.app.timers.unregister(snapshot_timer)
+	bpy.app.timers.register(snapshot_timer,
+		first_interval=max(wake - time.time(), 0), persistent=True)
+
+
+def set_previous_suggestion(idname):
+	"""Track the suggestion just accepted, checking right away for prev: rules"""
+	global PREVIOUS_SUGGESTION
+	PREVIOUS_SUGGESTION = idname
+	request_check()
+
+
+def plain_value(value):
+	"""Copy a property value into plain python, safe to read from any thread"""
+	if value is None or isinstance(value, (bool, int, float, str)):
+		return value
+	try:
+		items = tuple(value) # e.g. vector or color arrays
+	except TypeError:
+		return repr(value)
+	if all(isinstance(itm, (bool, int, float, str)) for itm in items):
+		return items
+	return repr(value)
+
+
+def capture_snapshot():
+	"""Copy the facts the compiled rules read into the immutable SNAPSHOT.
+
+	Only ever run on the main thread, this is the single place blender data is
+	read for suggestions. Wakes the background thread to evaluate it after,
+	and returns the number of new operators captured. Keys which changed are
+	collected into SNAPSHOT_CHANGES, for the worker to take with the snapshot.
+	"""
+	global SNAPSHOT
+	global SNAPSHOT_CHANGES
+	global LAST_CAPTURE_TIME
+
+	start = time.perf_counter()
+	context = bpy.context
+	with BANK_LOCK: # bank state must not change halfway through a capture
+		if PROFILE:
+			ops_start = clock_ns()
+			new_ops = update_ops_sequence()
+			record_timing("update_ops_sequence", clock_ns() - ops_start)
+		else:
+			new_ops = update_ops_sequence()
+		facts, changed = read_changed_facts(context)
+		if facts is not None:
+			SNAPSHOT = types.MappingProxyType(facts)
+		if changed is None:
+			SNAPSHOT_CHANGES = None
+		elif SNAPSHOT_CHANGES is not None:
+			SNAPSHOT_CHANGES.update(changed)
+	LAST_CAPTURE_TIME = time.perf_counter() - start
+	if PROFILE:
+		record_timing("capture_snapshot", int(LAST_CAPTURE_TIME*1e9))
+	if LAST_CAPTURE_TIME > CAPTURE_BUDGET:
+		log("Snapshot capture over budget: {:.3f}ms".format(
+			LAST_CAPTURE_TIME*1000))
+	WAKE_EVENT.set()
+	return new_ops
+
+
+def read_changed_facts(context):
+	"""Read the facts of the keys whose input source moved since last capture.
+
+	Each source has a version which is cheap to read, see source_version, and
+	only keys of sources whose version moved are read again. Props have no
+	version and are read in one walk of the prop tree each time. Returns the
+	new facts, or None if none changed, and the keys whose value changed, or
+	None for all keys after new rules were published.
+	"""
+	global CAPTURED_INDEX
+	global CAPTURED_VERSIONS
+	global CAPTURED_PATTERNS
+
+	if SNAPSHOT is None or CAPTURED_INDEX is not DEPENDENCY_INDEX:
+		CAPTURED_INDEX = DEPENDENCY_INDEX
+		CAPTURED_VERSIONS = {source: source_version(context, source)
+			for source in SOURCE_KEYS}
+		CAPTURED_PATTERNS = {kind: [key for key in SOURCE_KEYS[kind]
+			if GLOB_CHARS.search(key[1])]
+			for kind in NAME_INDEX_DATA if kind in SOURCE_KEYS}
+		props = read_prop_tree(context, PROP_TREE, {})
+		return {key: plain_value(read_fact(context, key, props))
+			for key in DEPENDENCY_INDEX}, None
+
+	last = SNAPSHOT
+	facts = None # copied from the last snapshot on the first change
+	changed = []
+	for source, keys in SOURCE_KEYS.items():
+		if source == "prop":
+			props = read_prop_tree(context, PROP_TREE, {})
+		else:
+			version = source_version(context, source)
+			old = CAPTURED_VERSIONS.get(source)
+			if old == version:
+				continue
+			CAPTURED_VERSIONS[source] = version
+			props = None
+			if source in NAME_INDEX_DATA and old is not None and old[0] is version[0]:
+				keys = renamed_keys(source, version[0].changed_since(old[1]), keys)
+		for key in keys:
+			value = plain_value(read_fact(context, key, props))
+			if value != last[key]:
+				if facts is None:
+					facts = last.copy()
+				facts[key] = value
+				changed.append(key)
+	return facts, changed
+
+
+def renamed_keys(kind, names, keys):
+	"""Returns the keys of a datablock kind which the added or removed names affect.
+
+	Exact names only change if that name did, patterns may on any name. All
+	keys are returned if the names are unknown, e.g. after a bulk resort.
+	"""
+	if names is None:
+		return keys
+	exact = [(kind, name) for name in set(names) if (kind, name) in DEPENDENCY_INDEX]
+	return exact + CAPTURED_PATTERNS.get(kind, [])
+
+
+def source_version(context, source):
+	"""Returns a value which changes whenever facts read from the source may.
+
+	Scene facts and name indexes are synced first, so their versions count
+	any rescan. Elapsed facts only move as thresholds are passed, and props
+	have no version, so None is returned and they are always read.
+	"""
+	if source == "prev":
+		return PREVIOUS_SUGGESTION
+	elif source == "ops":
+		return tuple(OPS_SEQUENCE), OPS_AUTOMATON and OPS_AUTOMATON.count
+	elif source == "scene":
+		get_scene_facts(context)
+		return SCENE_FACTS_VERSION
+	elif source == "elapsed":
+		return UI_LAST_CHECK, bisect.bisect_right(
+			ELAPSED_THRESHOLDS, time.time() - UI_LAST_CHECK)
+	elif source in NAME_INDEX_DATA:
+		index = get_name_index(context, source)
+		return index, index.version
+	return None
+
+
+def take_snapshot():
+	"""Returns SNAPSHOT and the keys changed since last taken, None for all"""
+	global SNAPSHOT_CHANGES
+	with BANK_LOCK:
+		changed = SNAPSHOT_CHANGES
+		SNAPSHOT_CHANGES = set()
+		return SNAPSHOT, changed
+
+
+def assistant_thread():
+	"""Long-running function in background thread to evaluate suggestions.
+
+	Never reads blender data, instead it sleeps on WAKE_EVENT until a new
+	SNAPSHOT is published by capture_snapshot and evaluates the rules against
+	it, exiting as soon as STOP_SERVER is set.
+	"""
+	global BACKGROUND_THREAD
+	global LAST_EVAL_TIME
+	global DISMISSED_LOADED
+	global PACKS_CHANGED
+	global PACKS_RELOADED
+
+	if not SUGGESTION_BANK:
+		load_suggestions()
+	if not DISMISSED_LOADED:
+		flush_dismissed_suggestions() # apply any reset queued before loading
+		load_dismissed_suggestions()
+		DISMISSED_LOADED = True
+
+	# primary never ending loop, cleared on exit so a crash can restart it
+	try:
+		while STOP_SERVER is False:
+			WAKE_EVENT.wait()
+			WAKE_EVENT.clear()
+			if STOP_SERVER is True:
+				break
+			flush_dismissed_suggestions()
+			if PACKS_CHANGED:
+				PACKS_CHANGED = False
+				load_suggestions()
+				PACKS_RELOADED = True
+			snapshot, changed = take_snapshot()
+			if snapshot is None:
+				continue
+			log("Checking now for suggestions")
+			start = time.perf_counter()
+			generate_suggestions(snapshot, changed)
+			LAST_EVAL_TIME = time.perf_counter() - start
+			if PROFILE:
+				record_timing("generate_suggestions", int(LAST_EVAL_TIME*1e9))
+	finally:
+		log("Stopping assistant thread\n")
+		BACKGROUND_THREAD = None
+
+
+def get_ignore_filter():
+	"""Returns one regex matching any ignored action, recompiled on change.
+
+	Combines IGNORE_ACTIONS with the comma-separated extra entries from the
+	addon preferences, so each operator line is checked with a single scan.
+	"""
+	global IGNORE_FILTER
+	global IGNORE_FILTER_KEY
+
+	prefs = get_addon_preferences()
+	extra = prefs.ignore_actions if prefs else ""
+	key = (tuple(IGNORE_ACTIONS), extra)
+	if key == IGNORE_FILTER_KEY:
+		return IGNORE_FILTER
+
+	entries = list(IGNORE_ACTIONS)
+	entries += [itm.strip() for itm in extra.split(",") if itm.strip()]
+	if entries:
+		IGNORE_FILTER = re.compile("|".join(re.escape(itm) for itm in entries))
+	else:
+		IGNORE_FILTER = None
+	IGNORE_FILTER_KEY = key
+	log("Compiled ignore filter for {} actions".format(len(entries)))
+	return IGNORE_FILTER
+
+
+def operator_line(op):
+	"""Convert a registered operator into its python bpy.ops call path"""
+	idname = op.bl_idname
+	if "_OT_" in idname:
+		mod, name = idname.split("_OT_", 1)
+		idname = mod.lower()+"."+name
+	return "bpy.ops."+idname
+
+
+def update_ops_sequence():
+	"""Captures operators ran since the last check into OPS_SEQUENCE.
+
+	Returns the number of new, not ignored, operators captured.
 
-	# clean up the generated text
-	bpy.data.texts.remove(new_texts[0])
-	log("Loaded {} actions".format(len(OPS_SEQUENCE)))
+	Keeps a cursor to the newest window manager operator already seen and only
+	walks the entries after it, so cost stays flat however long the session.
+	"""
+	global OPS_CURSOR
 
+	wm = bpy.context.window_manager
+	if wm is None or not hasattr(wm, "operators"):
+		return 0
+	operators = wm.operators
 
-def get_dismissed_suggestions():
-	"""Returns list of past dismissed suggestions"""
-	return list(DISMISSED)
+	# walk back from the newest operator until reaching the last captured one
+	new_ops = []
+	for i in range(len(operators)-1, -1, -1):
+		if operators[i].as_pointer() == OPS_CURSOR:
+			break
+		new_ops.append(operator_line(operators[i]))
+		if len(new_ops) >= LAST_N_ACTIONS:
+			break # older ones would fall out of the ring buffer anyway
+	if len(operators):
+		OPS_CURSOR = operators[-1].as_pointer()
+
+	ignore = get_ignore_filter()
+	automaton = OPS_AUTOMATON
+	now = time.time()
+	captured = 0
+	for line in reversed(new_ops):
+		if ignore is not None and ignore.search(line):
+			continue
+		OPS_SEQUENCE.append(line)
+		if automaton is not None:
+			automaton.advance(line[8:], now) # strip bpy.ops. prefix
+		captured += 1
+	log("Captured {} new actions".format(captured))
+	return captured
 
 
 def save_dismissed_suggestion(idname, disk=False):
-	"""Saves the fact that a suggestion was just dismissed"""
-	DISMISSED[idname] = disk
+	"""Saves the fact that a suggestion was just dismissed.
 
+	With disk, the id is queued for the dismissed log, which the background
+	thread appends in batches so the UI thread never waits on the file.
+	"""
+	global DISMISSED_VERSION
+	with DISMISSED_LOCK:
+		DISMISSED[idname] = disk
+		DISMISSED_VERSION += 1
+		if disk is True:
+			DISMISSED_PENDING.append(idname)
 	if disk is True:
-		log("Saving dismissed tips to file is not implemented yet")
+		WAKE_EVENT.set()
+
+
+def reset_dismissed_suggestions():
+	"""Forget all dismissed suggestions, including the dismissed log"""
+	global DISMISSED_VERSION
+	with DISMISSED_LOCK:
+		DISMISSED.clear()
+		DISMISSED_VERSION += 1
+		DISMISSED_PENDING.append(None) # marker to truncate the log
+	WAKE_EVENT.set()
+
+
+def load_dismissed_suggestions():
+	"""Load the dismissed log into DISMISSED, compacting it if worthwhile"""
+	global DISMISSED_LOG_LINES
+	global DISMISSED_VERSION
+	path = get_config_path(DISMISSED_LOG)
+	if not path or not os.path.isfile(path):
+		return
+	try:
+		with open(path, mode='r', encoding='utf-8') as infile:
+			lines = [line.strip() for line in infile]
+	except OSError as err:
+		log("Could not read dismissed log: "+str(err))
+		return
+	ids = [line for line in lines if line]
+	with DISMISSED_LOCK:
+		if None in DISMISSED_PENDING:
+			return # reset while reading, the log is about to be truncated
+		for idname in ids:
+			DISMISSED.setdefault(idname, True)
+		DISMISSED_VERSION += 1
+	DISMISSED_LOG_LINES = len(lines)
+	log("Loaded {} dismissed suggestions".format(len(ids)))
+	if DISMISSED_LOG_LINES > 2*len(set(ids)) + DISMISSED_COMPACT_SLACK:
+		compact_dismissed_log(path)
+
+
+def compact_dismissed_log(path):
+	"""Rewrite the dismissed log with each persisted id once"""
+	global DISMISSED_LOG_LINES
+	with DISMISSED_LOCK: # main thread may dismiss or reset meanwhile
+		ids = [idname for idname, disk in DISMISSED.items() if disk]
+	try:
+		with open(path+".tmp", mode='w', encoding='utf-8') as outfile:
+			outfile.write("".join(idname+"\n" for idname in ids))
+			outfile.flush()
+			os.fsync(outfile.fileno())
+		os.replace(path+".tmp", path)
+	except OSError as err:
+		log("Could not compact dismissed log: "+str(err))
+		return
+	DISMISSED_LOG_LINES = len(ids)
+	log("Compacted dismissed log to {} entries".format(len(ids)))
+
+
+def flush_dismissed_suggestions():
+	"""Append all queued dismissals to the log with a single fsync"""
+	global DISMISSED_LOG_LINES
+	with DISMISSED_LOCK:
+		if not DISMISSED_PENDING:
+			return
+		pending = DISMISSED_PENDING[:]
+		del DISMISSED_PENDING[:]
+	path = get_config_path(DISMISSED_LOG)
+	if not path:
+		return
+
+	# only what was queued after the last reset marker still applies
+	if None in pending:
+		pending = pending[len(pending) - pending[::-1].index(None):]
+		mode = 'w'
+		DISMISSED_LOG_LINES = 0
+	else:
+		mode = 'a'
+	try:
+		with open(path, mode=mode, encoding='utf-8') as outfile:
+			outfile.write("".join(idname+"\n" for idname in pending))
+			outfile.flush()
+			os.fsync(outfile.fileno())
+	except OSError as err:
+		log("Could not write dismissed log: "+str(err))
+		return
+	DISMISSED_LOG_LINES += len(pending)
+	if DISMISSED_LOG_LINES > 2*len(DISMISSED) + DISMISSED_COMPACT_SLACK:
+		compact_dismissed_log(path)
 
 
 # -----------------------------------------------------------------------------
@@ -271,155 +1317,1099 @@ def save_dismissed_suggestion(idname, disk=False):
 # -----------------------------------------------------------------------------
 
 
-def generate_suggestions():
+class Condition(object):
+	"""Base class for a single compiled condition of a suggestion row.
+
+	Conditions never read blender state directly, instead they test against
+	a dict of facts keyed by the input sources listed by keys().
+	"""
+	__slots__ = ()
+
+	def keys(self):
+		return ()
+
+	def test(self, facts):
+		raise NotImplementedError
+
+	def __repr__(self):
+		return "{}({})".format(self.__class__.__name__, ", ".join(
+			repr(getattr(self, slot)) for slot in self.__slots__))
+
+
+class CondNoPrev(Condition):
+	"""No suggestion has been accepted yet"""
+	__slots__ = ()
+
+	def keys(self):
+		return ("prev",)
+
+	def test(self, facts):
+		return facts["prev"] is None
+
+
+class CondPrev(Condition):
+	"""Previous suggestion is any of the given ids"""
+	__slots__ = ("any_of",)
+
+	def __init__(self, any_of):
+		self.any_of = frozenset(any_of)
+
+	def keys(self):
+		return ("prev",)
+
+	def test(self, facts):
+		return facts["prev"] in self.any_of
+
+
+class CondElapsed(Condition):
+	"""At least this many seconds passed since the last popup"""
+	__slots__ = ("seconds",)
+
+	def __init__(self, seconds):
+		self.seconds = seconds
+
+	def keys(self):
+		return (("elapsed", self.seconds),)
+
+	def test(self, facts):
+		return facts[("elapsed", self.seconds)]
+
+
+class CondOpsLast(Condition):
+	"""Operator is part of the last recorded operator line"""
+	__slots__ = ("op",)
+
+	def __init__(self, op):
+		self.op = op
+
+	def keys(self):
+		return ("ops",)
+
+	def test(self, facts):
+		ops = facts["ops"]
+		return bool(ops) and self.op in ops[-1]
+
+
+class CondOpsRecent(Condition):
+	"""Operator is part of any of the recently recorded operator lines"""
+	__slots__ = ("op",)
+
+	def __init__(self, op):
+		self.op = op
+
+	def keys(self):
+		return ("ops",)
+
+	def test(self, facts):
+		return any(self.op in line for line in facts["ops"])
+
+
+class CondOpsSeq(Condition):
+	"""Sequence of operators completed within the recent operators.
+
+	Written as ops_seq:a>b>c, where a>>b allows other operators in between
+	and an optional @30s suffix requires the whole sequence within 30s.
+	"""
+	__slots__ = ("pattern", "steps", "window")
+
+	def __init__(self, pattern):
+		self.pattern = pattern
+		body, _, window = pattern.partition("@")
+		self.window = parse_seconds(window) if window else None
+		steps = []
+		gap = False
+		for op in body.split(">"):
+			if not op:
+				if gap or not steps:
+					raise ValueError("Invalid operator sequence: "+pattern)
+				gap = True
+				continue
+			steps.append((op, gap))
+			gap = False
+		if gap or len(steps) < 2:
+			raise ValueError("Invalid operator sequence: "+pattern)
+		self.steps = tuple(steps)
+
+	def keys(self):
+		return (("ops_seq", self.pattern),)
+
+	def test(self, facts):
+		return facts[("ops_seq", self.pattern)]
+
+
+class OpsSequenceAutomaton(object):
+	"""Matches all ops_seq patterns of the bank, advanced once per operator.
+
+	Progress of each pattern is kept as matched step count to start time,
+	keeping only the latest start per count. Operators are looked up in an
+	index of the steps waiting for them, so advancing costs only the steps
+	that operator can move forward, plus dropping the partial matches which
+	didn't allow a gap, each of which is dropped only once.
+	"""
+	__slots__ = ("patterns", "index", "progress", "strict", "completed", "count")
+
+	def __init__(self, conditions):
+		self.patterns = {}
+		self.index = {}
+		for cond in conditions:
+			if cond.pattern in self.patterns:
+				continue
+			self.patterns[cond.pattern] = cond
+			for step, (op, _) in enumerate(cond.steps):
+				self.index.setdefault(op, []).append((cond.pattern, step))
+		self.progress = {pattern: {} for pattern in self.patterns}
+		self.strict = [] # (pattern, matched count) dropped by the next operator
+		self.completed = {} # pattern to operator count when last completed
+		self.count = 0 # total operators advanced over
+
+	def advance(self, op, now):
+		"""Advance all patterns over one newly ran operator idname"""
+		self.count += 1
+		advanced = []
+		for pattern, step in self.index.get(op, ()):
+			cond = self.patterns[pattern]
+			if step == 0:
+				start = now
+			else:
+				start = self.progress[pattern].get(step)
+				if start is None:
+					continue
+			if cond.window is not None and now - start > cond.window:
+				continue
+			advanced.append((pattern, step+1, start))
+
+		# partial matches not allowing a gap end on any operator
+		for pattern, matched in self.strict:
+			self.progress[pattern].pop(matched, None)
+		self.strict = []
+
+		for pattern, matched, start in advanced:
+			cond = self.patterns[pattern]
+			if matched == len(cond.steps):
+				self.completed[pattern] = self.count
+				continue
+			progress = self.progress[pattern]
+			if start >= progress.get(matched, start):
+				progress[matched] = start
+			if not cond.steps[matched][1]:
+				self.strict.append((pattern, matched))
+
+	def recently_completed(self, pattern):
+		"""Whether pattern completed within the last LAST_N_ACTIONS operators"""
+		done = self.completed.get(pattern)
+		return done is not None and self.count - done < LAST_N_ACTIONS
+
+
+class CondProp(Condition):
+	"""Property at the given path equals the pre-interpreted value"""
+	__slots__ = ("path", "value")
+
+	def __init__(self, path, value):
+		self.path = path
+		self.value = value
+
+	def keys(self):
+		return (("prop", self.path),)
+
+	def test(self, facts):
+		return facts[("prop", self.path)] == self.value
+
+
+class CondExists(Condition):
+	"""Datablock matching any of the name patterns exists, or not if negated"""
+	__slots__ = ("kind", "names", "negate")
+
+	def __init__(self, kind, names, negate=False):
+		self.kind = kind
+		self.names = frozenset(names)
+		self.negate = negate
+
+	def keys(self):
+		return tuple((self.kind, name) for name in self.names)
+
+	def test(self, facts):
+		found = any(facts[(self.kind, name)] for name in self.names)
+		return found is not self.negate
+
+
+class CondIsVoid(Condition):
+	"""Scene has no objects"""
+	__slots__ = ()
+
+	def keys(self):
+		return ("object_count",)
+
+	def test(self, facts):
+		return facts["object_count"] == 0
+
+
+class CondNoCamera(Condition):
+	"""Scene has no camera object"""
+	__slots__ = ()
+
+	def keys(self):
+		return ("has_camera",)
+
+	def test(self, facts):
+		return not facts["has_camera"]
+
+
+def parse_seconds(value):
+	"""Convert an elapsed value like 10s into seconds, raising ValueError"""
+	if value.endswith("s"):
+		value = value[:-1]
+	return int(value)
+
+
+def compile_condition(cond):
+	"""Compile a single type:value condition string into a Condition object.
+
+	Returns None for conditions which need no runtime check, and raises
+	ValueError for unrecognized or malformed conditions.
+	"""
+	if cond == "not_dismissed":
+		return None # accounted for by the dismissed check of each rule
+	elif cond == "no_prev": # essentially only used by first tutorial
+		return CondNoPrev()
+	elif cond == "is_void":
+		return CondIsVoid()
+	elif cond == "no_camera":
+		return CondNoCamera()
+
+	ctype, _, value = cond.partition(":")
+	if not value:
+		raise ValueError("Condition type not recognized: "+cond)
+	if ctype == "prev":
+		return CondPrev(value.split(","))
+	elif ctype == "elapsed":
+		return CondElapsed(parse_seconds(value))
+	elif ctype == "ops_last":
+		return CondOpsLast(value)
+	elif ctype == "ops_recent":
+		return CondOpsRecent(value)
+	elif ctype == "ops_seq":
+		return CondOpsSeq(value)
+	elif ctype == "prop":
+		if "=" not in value:
+			raise ValueError("Property condition missing value: "+cond)
+		field = value[:value.index("=")] # safer than split
+		return CondProp(field, interpret_value(value[1+value.index("="):]))
+	elif ctype in EXISTS_CONDITIONS:
+		kind, negate = EXISTS_CONDITIONS[ctype]
+		return CondExists(kind, value.split(","), negate=negate)
+	raise ValueError("Condition type not recognized: "+cond)
+
+
+def compile_conditions(condition):
+	"""Compile a space-separated condition column into a tuple of Conditions"""
+	predicates = []
+	for cond in condition.split(" "):
+		if not cond:
+			continue
+		pred = compile_condition(cond)
+		if pred is not None:
+			predicates.append(pred)
+	return tuple(predicates)
+
+
+
+def build_dependency_index(rules):
+	"""Map each input source to the indices of the compiled rules reading it.
+
+	Returns the dependency index, its keys by input source, prop tree,
+	elapsed thresholds and ops automaton of the rules, for publish_rules to
+	swap in.
+	"""
+	index = {}
+	for i, (_, predicates) in enumerate(rules):
+		for pred in predicates:
+			for key in pred.keys():
+				index.setdefault(key, set()).add(i)
+	sources = {}
+	for key in index:
+		sources.setdefault(key_source(key), []).append(key)
+	prop_tree = build_prop_tree(
+		key[1] for key in index if isinstance(key, tuple) and key[0] == "prop")
+	thresholds = sorted(
+		key[1] for key in index if isinstance(key, tuple) and key[0] == "elapsed")
+	sequences = [pred for _, predicates in rules
+		for pred in predicates if isinstance(pred, CondOpsSeq)]
+	automaton = OpsSequenceAutomaton(sequences) if sequences else None
+	return index, sources, prop_tree, thresholds, automaton
+
+
+def key_source(key):
+	"""Returns the input source a dependency key is read from, see source_version"""
+	if key in ("object_count", "has_camera"):
+		return "scene"
+	elif not isinstance(key, tuple):
+		return key # prev or ops
+	elif key[0] == "ops_seq":
+		return "ops" # completions only move as operators are captured
+	return key[0] # elapsed, prop or a datablock kind
+
+
+class RuleGroup(object):
+	"""Rules of a view shown under the same previous suggestion.
+
+	Members is the sorted index array of the rules. Of those not dismissed,
+	pending ones are kept in a heap and matching ones in a sorted list, so the
+	first candidate is found without stepping through rules cached as not
+	matching. Heap entries are dropped lazily once no longer pending.
+	"""
+	__slots__ = ("members", "pending", "matching")
+
+	def __init__(self, members=()):
+		self.members = members
+		self.pending = []
+		self.matching = []
+
+	def push_pending(self, i):
+		"""Queue a rule for evaluation, compacting the heap if mostly outdated"""
+		heapq.heappush(self.pending, i)
+		if len(self.pending) > 2*len(self.members) + 64:
+			self.pending = sorted(set(j for j in self.pending
+				if j in PENDING_RULES and j not in HIDDEN_RULES))
+
+	def next_pending(self):
+		"""Returns the lowest pending index, or None"""
+		pending = self.pending
+		while pending and (pending[0] not in PENDING_RULES
+				or pending[0] in HIDDEN_RULES):
+			heapq.heappop(pending)
+		return pending[0] if pending else None
+
+	def next_matching(self, after):
+		"""Returns the lowest matching index above after, or None"""
+		pos = bisect.bisect_right(self.matching, after)
+		return self.matching[pos] if pos < len(self.matching) else None
+
+
+def build_views(rules, pending=(), matching=()):
+	"""Precompute the rules shown for each helpful and category preference.
+
+	Keys are (helpful only, category or None for any), for every category in
+	the bank. Each view is (prev buckets, general rules) of only the rules it
+	shows: buckets map a previous suggestion id, None for no_prev, to the
+	RuleGroup of rules requiring it, the cheapest condition to tell
+	candidates apart. General rules have neither condition. Rules filtered out
+	of a view are never walked by generate_suggestions while it is active.
+	Returns the views and the RuleGroups of each rule, filled with the given
+	pending and matching indices.
+	"""
+	views = {(False, None): ({}, [])}
+	for i, (entry, predicates) in enumerate(rules):
+		helpful = entry.get("helpful", "").upper() == "TRUE"
+		category = entry.get("category") or None
+		keys = [(False, None)]
+		if helpful:
+			keys.append((True, None))
+		if category:
+			keys.append((False, category))
+			if helpful:
+				keys.append((True, category))
+		prevs = rule_prev_values(predicates)
+		for key in keys:
+			buckets, general = views.setdefault(key, ({}, []))
+			if prevs is None:
+				general.append(i)
+			for prev in prevs or ():
+				buckets.setdefault(prev, []).append(i)
+	views = {key: ({prev: RuleGroup(tuple(ids)) for prev, ids in buckets.items()},
+		RuleGroup(tuple(general))) for key, (buckets, general) in views.items()}
+
+	groups = [[] for _ in rules]
+	for buckets, general in views.values():
+		for group in itertools.chain(buckets.values(), (general,)):
+			for i in group.members:
+				groups[i].append(group)
+				if i in pending:
+					group.pending.append(i) # sorted, so already a heap
+				elif i in matching:
+					group.matching.append(i)
+	return views, groups
+
+
+def set_view(helpful, category=None):
+	"""Switch the rules shown to those matching the helpful and category preferences"""
+	global VIEW_KEY
+	global ACTIVE_VIEW
+	VIEW_KEY = (bool(helpful), category or None)
+	ACTIVE_VIEW = RULE_VIEWS.get(VIEW_KEY, EMPTY_VIEW)
+
+
+def rule_prev_values(predicates):
+	"""Returns the previous suggestion ids a rule can match under, or None.
+
+	None means any, as the rule has no prev or no_prev condition. No
+	previous suggestion is included as None for no_prev.
+	"""
+	for pred in predicates:
+		if isinstance(pred, CondPrev):
+			return pred.any_of
+		elif isinstance(pred, CondNoPrev):
+			return (None,)
+	return None
+
+
+def build_prop_tree(paths):
+	"""Organize dotted prop paths into a prefix tree sharing their segments.
+
+	Each node maps a segment to [full path, whether a path ends here, child
+	nodes], so e.g. scene.render.* paths all hang below one render node.
+	"""
+	tree = {}
+	for path in paths:
+		node = tree
+		segs = path.split(".")
+		for i, seg in enumerate(segs):
+			entry = node.setdefault(seg, [".".join(segs[:i+1]), False, {}])
+			if i == len(segs)-1:
+				entry[1] = True
+			node = entry[2]
+	return tree
+
+
+def read_prop_tree(base, tree, values):
+	"""Resolve all paths of a prop tree in one walk, into a flat values dict.
+
+	Each intermediate struct is looked up once no matter how many paths go
+	through it, missing attributes resolve to None like individual lookups.
+	"""
+	for seg, (path, is_leaf, children) in tree.items():
+		value = getattr(base, seg, None) if base is not None else None
+		if is_leaf:
+			values[path] = value
+		if children:
+			read_prop_tree(value, children, values)
+	return values
+
+
+def read_fact(context, key, props=None):
+	"""Read the current value of a single input source used by conditions.
+
+	Prop values are taken from props if given, as resolved by read_prop_tree.
+	"""
+	if key == "prev":
+		return PREVIOUS_SUGGESTION
+	elif key == "ops":
+		return tuple(OPS_SEQUENCE)
+	elif key == "object_count":
+		return get_scene_facts(context)["object_count"]
+	elif key == "has_camera":
+		return not has_no_camera(context)
+	elif key[0] == "ops_seq":
+		return OPS_AUTOMATON is not None and \
+			OPS_AUTOMATON.recently_completed(key[1])
+	elif key[0] == "elapsed":
+		return time.time() - UI_LAST_CHECK >= key[1]
+	elif key[0] in NAME_INDEX_DATA:
+		return get_name_index(context, key[0]).match(key[1])
+	elif key[0] == "prop":
+		if props is not None and key[1] in props:
+			return props[key[1]]
+		return get_prop_value_from_string(context, key[1])
+	raise KeyError(key)
+
+
+def generate_suggestions(snapshot, changed=None):
 	"""The primary function to set the next suggestion, from background thread
 
-	As new suggestions are added, they shoudl be accounted for here.
+	Pure evaluation of the compiled rules against a snapshot of facts. Only
+	rules in the active view for the current previous suggestion are
+	candidates, in priority order, and stopping at the first match. Of those,
+	only rules whose input sources changed since they were last tested are
+	evaluated again, and rules cached as not matching are skipped without
+	being looked at, so a check costs what changed rather than the bank size.
+	Only the changed keys are diffed if given, as taken by take_snapshot.
 	"""
 	global SUGGESTIONS
+	global LAST_FACTS
 
-	context = bpy.context
-
-	# go through types of conditions, order matters
+	# flag rules reading input sources which changed since last cycle
+	for key in DEPENDENCY_INDEX if changed is None else changed:
+		if key not in snapshot:
+			log("Snapshot taken before suggestions loaded, skipping")
+			return
+		if key not in LAST_FACTS or LAST_FACTS[key] != snapshot[key]:
+			mark_pending(DEPENDENCY_INDEX[key])
+	LAST_FACTS = snapshot
+	sync_hidden_rules()
+
+	# indices are in priority order, so the next candidate is the lowest
+	# pending or matching index of the groups, skipping all other rules
+	matches = rule_matches_profiled if PROFILE else rule_matches
+	buckets, general = ACTIVE_VIEW
+	prev = snapshot.get("prev")
+	groups = tuple(group for group in (general, buckets.get(prev))
+		if group is not None)
 	local_sugg = {}
-	if PREVIOUS_SUGGESTION:
-		prev_id = PREVIOUS_SUGGESTION
-	else:
-		prev_id = "n/a"
-	for sugg_set in SUGGESTION_BANK:
-		log("Checking condition: {} (prev:{})".format(
-			sugg_set["id"], prev_id))
-		if sugg_set["id"] in get_dismissed_suggestions():
+	evaluated = 0
+	after = -1
+	while True:
+		pending = matching = None
+		for group in groups:
+			i = group.next_pending()
+			if i is not None and (pending is None or i < pending):
+				pending = i
+			i = group.next_matching(after)
+			if i is not None and (matching is None or i < matching):
+				matching = i
+		if matching is not None and (pending is None or matching < pending):
+			after = matching
+		elif pending is not None:
+			after = pending
+			PENDING_RULES.discard(pending)
+			evaluated += 1
+			if not matches(pending, snapshot):
+				continue
+		else:
+			break
+		sugg_set = COMPILED_RULES[after][0]
+		if sugg_set["id"] in DISMISSED:
+			continue # dismissed since hidden rules were synced
+		local_sugg = sugg_set
+		log("Condition met for {}, assigning".format(sugg_set["id"]))
+		break
+	log("Evaluated {} of {} rules".format(evaluated, len(COMPILED_RULES)))
+	SUGGESTIONS = local_sugg
+
+
+def mark_pending(indices):
+	"""Flag rules as out of date, queueing them in the RuleGroups showing them"""
+	for i in indices:
+		if i in PENDING_RULES:
 			continue
+		PENDING_RULES.add(i)
+		if i not in HIDDEN_RULES:
+			for group in RULE_GROUPS[i]:
+				group.push_pending(i)
 
-		# iterate through space-separate set of conditions
-		conditions = sugg_set["condition"].split(" ")
-		log("Conditions for set {}: {}".format(sugg_set["id"], str(conditions)))
-		condition_met = True
 
-		# check each sub condition for being a match
-		for cond in conditions:
-			if cond == "not_dismissed":
-				continue # already accounted for by being here
-			elif cond == "no_prev": # essentially only used by first tutorial
-				if PREVIOUS_SUGGESTION is not None:
-					condition_met = False
-					break
-			elif cond.startswith("prev:"):
-				any_of = cond[5:].split(",")
-				if PREVIOUS_SUGGESTION not in any_of:
-					condition_met = False
-					break
-			elif cond.startswith("elapsed:"):
-				interval = cond[8:-1] # assumes s at end for seconds
-				if int(interval) > time.time() - UI_LAST_CHECK:
-					condition_met = False
-					break
-			elif cond.startswith("ops_last:"):
-				# check if last operator was this one
-				if cond[9:] not in OPS_SEQUENCE[-1]:
-					condition_met = False
-					break
-			elif cond.startswith("ops_recent:"):
-				# check if operator was used recently
-				op_used = False
-				for one_op in OPS_SEQUENCE:
-					if cond[11:] in OPS_SEQUENCE:
-						op_used = True
-						break
-				if not op_used:
-					condition_met = False
-					break
-			elif cond.startswith("prop:"):
-				log("Conditional check")
-				if "=" not in cond:
-					condition_met = False
-					break
-				field = cond[5:cond.index("=")] # safer than split
-				value = cond[1+cond.index("="):]
-				prop = get_prop_value_from_string(context, field)
-				if prop != interpret_value(value):
-					condition_met = False
-					break
-			elif cond.startswith("object_exists:"):
-				if cond[14:] not in bpy.data.objects:
-					condition_met = False
-					break
-			elif cond.startswith("no_object_exists:"):
-				if cond[17:] in bpy.data.objects:
-					condition_met = False
-					break
-			elif cond == "is_void":
-				if not is_void(context):
-					condition_met = False
-					break
-			elif cond == "no_camera":
-				if not has_no_camera(context):
-					condition_met = False
-					break
-			else: # others or not implemented
-				log("Condition type not recognized:"+str(cond))
-				condition_met = False
-
-		if condition_met is True:
-			local_sugg = sugg_set
-			log("Condition met, assigning")
-			break
+def set_verdict(i, met):
+	"""Cache whether a rule matched, in MATCHING_RULES and its RuleGroups"""
+	if met == (i in MATCHING_RULES):
+		return
+	if met:
+		MATCHING_RULES.add(i)
+	else:
+		MATCHING_RULES.discard(i)
+	if i in HIDDEN_RULES:
+		return
+	for group in RULE_GROUPS[i]:
+		if met:
+			bisect.insort(group.matching, i)
 		else:
-			continue
-	SUGGESTIONS = local_sugg
+			del group.matching[bisect.bisect_left(group.matching, i)]
+
+
+def sync_hidden_rules():
+	"""Leave rules of dismissed suggestions out of all RuleGroups.
+
+	Only does work when DISMISSED changed since the last call, and then only
+	for the rules of the dismissed ids, so dismissed matches are never
+	stepped through by generate_suggestions.
+	"""
+	global HIDDEN_RULES
+	global HIDDEN_VERSION
+	if HIDDEN_VERSION == DISMISSED_VERSION:
+		return
+	with DISMISSED_LOCK:
+		HIDDEN_VERSION = DISMISSED_VERSION
+		dismissed = list(DISMISSED)
+	hidden = set(i for idname in dismissed
+		for i in RULE_INDICES.get(idname, ()))
+	shown = HIDDEN_RULES - hidden
+	for i in hidden - HIDDEN_RULES:
+		if i in MATCHING_RULES:
+			for group in RULE_GROUPS[i]:
+				del group.matching[bisect.bisect_left(group.matching, i)]
+	HIDDEN_RULES = hidden
+	for i in shown:
+		for group in RULE_GROUPS[i]:
+			if i in MATCHING_RULES:
+				bisect.insort(group.matching, i)
+			if i in PENDING_RULES:
+				group.push_pending(i)
+
+
+def rule_matches(i, snapshot):
+	"""Test all conditions of a compiled rule, caching the verdict"""
+	for pred in COMPILED_RULES[i][1]:
+		if not pred.test(snapshot):
+			set_verdict(i, False)
+			return False
+	set_verdict(i, True)
+	return True
+
+
+def mark_scene_facts_dirty(depsgraph=None):
+	"""Apply depsgraph updates to the cached scene facts, or flag a rescan.
+
+	New objects are counted and new or renamed datablocks noted in their
+	name index as they show up in updates, while updates which only touch
+	the transform, geometry or shading of counted objects are skipped.
+	Removals are not part of depsgraph updates, so updates which may remove
+	datablocks flag COUNTS_STALE, and refresh_scene_facts compares counts and
+	rescans if needed ahead of the next capture. Counting is a full walk in
+	blender, too slow for a handler running on every update.
+	"""
+	global SCENE_FACTS_DIRTY
+	global COUNTS_STALE
+	if SCENE_FACTS_DIRTY is True:
+		return
+	scene = getattr(depsgraph, "scene", None)
+	if scene is None or not hasattr(depsgraph, "updates") \
+			or scene.name != SCENE_FACTS.get("scene"):
+		SCENE_FACTS_DIRTY = True # e.g. blender 2.7x scene updates
+		return
+	structural = False
+	for update in depsgraph.updates:
+		datablock = getattr(update.id, "original", update.id)
+		if isinstance(datablock, bpy.types.Object):
+			known = SCENE_OBJECTS.get(datablock.as_pointer())
+			if known is None:
+				count_scene_object(datablock)
+			elif update.is_updated_geometry and known != datablock.type:
+				count_scene_object(datablock) # converted to another type
+				continue
+			elif update.is_updated_transform \
+					or update.is_updated_geometry \
+					or update.is_updated_shading:
+				continue # names and types unchanged
+		elif not isinstance(datablock, STRUCTURAL_TYPES):
+			continue # e.g. mesh edits
+		structural = True
+		for kind, datablock_type in NAME_INDEX_TYPES:
+			if kind in NAME_INDEXES and isinstance(datablock, datablock_type):
+				NAME_INDEXES[kind].note(datablock)
+	if structural:
+		COUNTS_STALE = True
+
+
+def count_scene_object(ob):
+	"""Add a new object to the cached counts, or recount it if its type changed"""
+	global SCENE_FACTS_VERSION
+	SCENE_FACTS_VERSION += 1
+	pointer = ob.as_pointer()
+	type_counts = SCENE_FACTS["type_counts"]
+	old = SCENE_OBJECTS.get(pointer)
+	if old is None:
+		SCENE_FACTS["object_count"] += 1
+	else:
+		type_counts[old] -= 1
+	type_counts[ob.type] = type_counts.get(ob.type, 0) + 1
+	SCENE_OBJECTS[pointer] = ob.type
+
+
+def refresh_scene_facts(context):
+	"""Run any rescan of scene facts or name indexes flagged since last check.
+
+	Called by snapshot_timer ahead of capture_snapshot, so the occasional
+	full rescan after removals stays out of the timed capture and BANK_LOCK.
+	Only what rules read was ever built, and so is refreshed. Removals are
+	found by comparing counts, once per check and only after updates which
+	may have removed datablocks.
+	"""
+	global SCENE_FACTS_DIRTY
+	global COUNTS_STALE
+	global NAMES_DIRTY
+	if COUNTS_STALE:
+		COUNTS_STALE = False
+		if SCENE_FACTS and len(context.scene.objects) != SCENE_FACTS["object_count"]:
+			SCENE_FACTS_DIRTY = True # objects removed, only found by a rescan
+		elif any(len(get_datablocks(kind)) != len(index.ids)
+				for kind, index in NAME_INDEXES.items()):
+			NAMES_DIRTY = True # datablocks removed, only found by a rescan
+	if SCENE_FACTS:
+		get_scene_facts(context)
+	if NAMES_DIRTY:
+		sync_name_indexes()
+
+
+def sync_name_indexes():
+	"""Rescan the names of all datablock kinds with an index"""
+	global NAMES_DIRTY
+	for kind, index in NAME_INDEXES.items():
+		index.sync(get_datablocks(kind))
+	NAMES_DIRTY = False
+
+
+def get_scene_facts(context):
+	"""Returns cached object count and per-type counts, syncing name indexes.
+
+	Kept up to date from depsgraph updates by mark_scene_facts_dirty, and
+	only rescanned when flagged dirty or the scene changed, normally by
+	refresh_scene_facts ahead of the capture reading it.
+	"""
+	global SCENE_FACTS
+	global SCENE_FACTS_DIRTY
+	global SCENE_OBJECTS
+	global SCENE_FACTS_VERSION
+
+	scene = context.scene
+	if SCENE_FACTS_DIRTY is False and SCENE_FACTS.get("scene") == scene.name:
+		return SCENE_FACTS
+
+	type_counts = {}
+	objects = {}
+	for ob in scene.objects:
+		type_counts[ob.type] = type_counts.get(ob.type, 0) + 1
+		objects[ob.as_pointer()] = ob.type
+	SCENE_OBJECTS = objects
+	SCENE_FACTS = {
+		"scene": scene.name,
+		"object_count": len(objects),
+		"type_counts": type_counts
+	}
+	SCENE_FACTS_VERSION += 1
+	sync_name_indexes()
+	SCENE_FACTS_DIRTY = False
+	log("Recomputed scene facts for {} objects".format(
+		SCENE_FACTS["object_count"]))
+	return SCENE_FACTS
+
+
+class NameIndex(object):
+	"""Sorted index of datablock names for exact, prefix and glob lookups.
+
+	Also maps the pointer of each datablock to its name, so new and renamed
+	datablocks reported by depsgraph updates are applied without a rescan.
+	Names count the datablocks holding them, as names can repeat across
+	libraries or before a rename has been made unique. The version counts
+	changes to the set of names, the latest of which are kept in the log.
+	"""
+	__slots__ = ("ids", "names", "sorted_names", "version", "log")
+
+	def __init__(self):
+		self.ids = {}
+		self.names = collections.Counter()
+		self.sorted_names = []
+		self.version = 0
+		self.log = [] # names added or removed by the latest versions
+
+	def sync(self, datablocks):
+		"""Update the index to hold exactly the given datablocks, incrementally"""
+		ids = {datablock.as_pointer(): datablock.name for datablock in datablocks}
+		names = collections.Counter(ids.values())
+		if names.keys() == self.names.keys(): # usual on rescans, only counts moved
+			added = removed = ()
+		else:
+			added = [name for name in names if name not in self.names]
+			removed = [name for name in self.names if name not in names]
+		if len(added) + len(removed) > 64:
+			self.sorted_names = sorted(names) # cheaper to sort in bulk
+			self.version += 1
+			self.log = [] # too many to list, see changed_since
+		else:
+			for name in removed:
+				del self.sorted_names[bisect.bisect_left(self.sorted_names, name)]
+				self.changed(name)
+			for name in added:
+				bisect.insort(self.sorted_names, name)
+				self.changed(name)
+		self.ids = ids
+		self.names = names
+
+	def note(self, datablock):
+		"""Add a new datablock or apply its rename, as reported by an update"""
+		pointer = datablock.as_pointer()
+		name = datablock.name
+		old = self.ids.get(pointer)
+		if old == name:
+			return
+		self.ids[pointer] = name
+		if old is not None:
+			self.names[old] -= 1
+			if self.names[old] <= 0: # last datablock holding the old name
+				del self.names[old]
+				del self.sorted_names[bisect.bisect_left(self.sorted_names, old)]
+				self.changed(old)
+		if name not in self.names:
+			bisect.insort(self.sorted_names, name)
+			self.changed(name)
+		self.names[name] += 1
+
+	def changed(self, name):
+		"""Log a name added to or removed from the index as a new version"""
+		self.version += 1
+		self.log.append(name)
+		if len(self.log) > NAME_LOG_SIZE:
+			del self.log[:len(self.log) - NAME_LOG_SIZE//2]
+
+	def changed_since(self, version):
+		"""Returns the names added or removed after the version, None if unknown"""
+		if version < self.version - len(self.log):
+			return None # fell out of the log
+		return self.log[len(self.log) - (self.version - version):]
+
+	def match(self, pattern):
+		"""Whether any name matches the exact name, prefix* or glob pattern"""
+		wild = GLOB_CHARS.search(pattern)
+		if wild is None:
+			return pattern in self.names
+
+		# only names sharing the literal prefix can match, which are adjacent
+		prefix = pattern[:wild.start()]
+		start = bisect.bisect_left(self.sorted_names, prefix)
+		if pattern == prefix+"*":
+			return start < len(self.sorted_names) and \
+				self.sorted_names[start].startswith(prefix)
+		matcher = glob_matcher(pattern)
+		for i in range(start, len(self.sorted_names)):
+			name = self.sorted_names[i]
+			if not name.startswith(prefix):
+				break
+			if matcher(name):
+				return True
+		return False
+
+
+@functools.lru_cache(maxsize=256)
+def glob_matcher(pattern):
+	"""Returns a compiled case-sensitive match function for a glob pattern"""
+	return re.compile(fnmatch.translate(pattern)).match
+
+
+def get_datablocks(kind):
+	"""Returns all datablocks of the kind, e.g. bpy.data.objects"""
+	for attr in NAME_INDEX_DATA[kind]:
+		if hasattr(bpy.data, attr):
+			return getattr(bpy.data, attr)
+	return []
+
+
+def get_name_index(context, kind):
+	"""Returns the name index of the datablock kind, shared by all rules"""
+	get_scene_facts(context) # syncs existing indexes if scene changed
+	if NAMES_DIRTY:
+		sync_name_indexes()
+	index = NAME_INDEXES.get(kind)
+	if index is None:
+		index = NameIndex()
+		index.sync(get_datablocks(kind))
+		NAME_INDEXES[kind] = index
+	return index
 
 
 def is_void(context):
 	"""Checks to see that the current scene is empty, ie a void"""
-	if not context.scene.objects:
-		return True
-	return False
+	return get_scene_facts(context)["object_count"] == 0
 
 
 def has_no_camera(context):
 	"""Checks if there is no camera in scene"""
-	for ob in context.scene.objects:
-		if ob.type == "CAMERA":
-			return False
-	return True
+	return get_scene_facts(context)["type_counts"].get("CAMERA", 0) == 0
 
 
-def get_prop_value_from_string(context, prop):
-	"""Given string, return the actual property value assuming context base"""
-	prop_segments = prop.split(".")
+@functools.lru_cache(maxsize=512)
+def prop_accessor(prop):
+	"""Compile a dotted property path into a getter, parent getter and name"""
+	parent, _, attr = prop.rpartition(".")
+	parent_getter = operator.attrgetter(parent) if parent else None
+	return operator.attrgetter(prop), parent_getter, attr
+
+
+def note_missing_prop(context, prop):
+	"""Remember a path as missing if it doesn't exist in this blender version.
+
+	Paths only failing because of an unset pointer, like a None active object,
+	are not remembered as they may resolve later.
+	"""
 	tmp = context
-	for seg in prop_segments:
-		if hasattr(tmp, seg):
-			tmp = getattr(tmp, seg)
-		else:
-			tmp = None
+	for seg in prop.split("."):
+		if tmp is None:
+			return
+		if not hasattr(tmp, seg):
 			break
-	return tmp
+		tmp = getattr(tmp, seg)
+	else:
+		return
+	if len(MISSING_PROPS) >= 512:
+		MISSING_PROPS.clear()
+	MISSING_PROPS.add(prop)
+	log("Property path not available: "+prop)
+
+
+def get_prop_value_from_string(context, prop):
+	"""Given string, return the actual property value assuming context base"""
+	if prop in MISSING_PROPS:
+		return None
+	try:
+		return prop_accessor(prop)[0](context)
+	except AttributeError:
+		note_missing_prop(context, prop)
+		return None
 
 
 def set_prop_value_from_string(context, prop, value):
 	"""Given prop string and value, assign value to property"""
-	prop_segments = prop.split(".")
-	tmp = context
-	for seg in prop_segments[:-1]:
-		if hasattr(tmp, seg):
-			tmp = getattr(tmp, seg)
-		else:
-			return
-	setattr(tmp, prop_segments[-1], value)
+	if prop in MISSING_PROPS:
+		return
+	_, parent_getter, attr = prop_accessor(prop)
+	try:
+		tmp = parent_getter(context) if parent_getter else context
+		setattr(tmp, attr, value)
+	except AttributeError:
+		note_missing_prop(context, prop)
 
 
 def interpret_value(value):
-	"""Take string input as if python convert and interpret as variable"""
+	"""Take string input as if python convert and interpret as variable.
+
+	Raises ValueError for anything but a boolean, number or quoted string.
+	"""
 	# for booleans
 	if value.lower()=="false":
 		return False
 	if value.lower()=="true":
 		return True
 	# string
-	if len(value)>2 and value[0]==value[-1] and value[0] in ["'", "\""]:
+	if len(value)>=2 and value[0]==value[-1] and value[0] in ["'", "\""]:
 		return value[1:-1]
+	# numbers
+	try:
+		return int(value)
+	except ValueError:
+		pass
+	try:
+		return float(value)
+	except ValueError:
+		raise ValueError("Value not recognized: "+value)
+
+
+# -----------------------------------------------------------------------------
+# Performance instrumentation
+# -----------------------------------------------------------------------------
+
+
+class TimingRing(object):
+	"""Preallocated ring of the latest durations of a section, in nanoseconds.
+
+	Recording is a single store and two increments, percentiles are only
+	computed when a report is requested.
+	"""
+	__slots__ = ("samples", "index", "count", "since")
+
+	def __init__(self, size=PROFILE_SAMPLES):
+		self.samples = array.array('q', [0]) * size
+		self.index = 0
+		self.count = 0 # all calls recorded, may exceed the ring size
+		self.since = clock_ns()
+
+	def add(self, duration):
+		self.samples[self.index] = duration
+		self.index = (self.index + 1) % len(self.samples)
+		self.count += 1
+
+	def summary(self):
+		"""Returns number of calls, calls per second and p50/p99 in ms"""
+		samples = sorted(self.samples[:min(self.count, len(self.samples))])
+		seconds = (clock_ns() - self.since) / 1e9
+		summary = {
+			"calls": self.count,
+			"rate": self.count / seconds if seconds > 0 else 0.0}
+		for name, fraction in (("p50", 0.5), ("p99", 0.99)):
+			summary[name] = samples[int(fraction*(len(samples)-1))] / 1e6 \
+				if samples else 0.0
+		return summary
+
+
+def set_profiling(enabled):
+	"""Turn recording of timings on or off, starting from cleared stats"""
+	global PROFILE
+	reset_profile()
+	PROFILE = bool(enabled)
+
+
+def reset_profile():
+	"""Clear all recorded timings"""
+	global RULE_TIMINGS
+	global RULE_EVALS
+	PROFILE_TIMINGS.clear()
+	CONDITION_TIMINGS.clear()
+	RULE_TIMINGS = array.array('q', [0]) * len(COMPILED_RULES)
+	RULE_EVALS = array.array('q', [0]) * len(COMPILED_RULES)
+
+
+def record_timing(name, duration):
+	"""Add the duration in nanoseconds of one call of a timed section"""
+	ring = PROFILE_TIMINGS.get(name)
+	if ring is None:
+		ring = PROFILE_TIMINGS[name] = TimingRing()
+	ring.add(duration)
+
+
+def rule_matches_profiled(i, snapshot):
+	"""Same as rule_matches, timing the rule and each of its conditions.
+
+	Used instead of rule_matches while profiling, so that carries no timing
+	overhead at all when disabled.
+	"""
+	if len(RULE_TIMINGS) != len(COMPILED_RULES):
+		reset_profile() # bank reloaded since profiling started
+	clock = clock_ns
+	rule_start = clock()
+	met = True
+	for pred in COMPILED_RULES[i][1]:
+		start = clock()
+		result = pred.test(snapshot)
+		stat = CONDITION_TIMINGS.get(pred.__class__.__name__)
+		if stat is None:
+			stat = CONDITION_TIMINGS[pred.__class__.__name__] = [0, 0]
+		stat[0] += clock() - start
+		stat[1] += 1
+		if not result:
+			met = False
+			break
+	set_verdict(i, met)
+	RULE_TIMINGS[i] += clock() - rule_start
+	RULE_EVALS[i] += 1
+	return met
+
+
+def get_profile_report(top=10):
+	"""Summarize recorded timings into a json friendly dict.
+
+	Includes p50/p99 latency and call rate of each timed section, the top
+	rules by total evaluation time and the cost per condition type.
+	"""
+	rules = []
+	rule_timings = RULE_TIMINGS
+	rule_evals = RULE_EVALS
+	for i, (entry, _) in enumerate(COMPILED_RULES):
+		if i >= len(rule_evals) or not rule_evals[i]:
+			continue
+		rules.append({
+			"id": entry["id"],
+			"evaluations": rule_evals[i],
+			"total_ms": rule_timings[i] / 1e6,
+			"mean_us": rule_timings[i] / rule_evals[i] / 1e3})
+	rules.sort(key=lambda rule: rule["total_ms"], reverse=True)
+	conditions = {name: {
+			"tests": tests,
+			"total_ms": total / 1e6,
+			"mean_us": total / tests / 1e3}
+		for name, (total, tests) in CONDITION_TIMINGS.items() if tests}
+	return {
+		"enabled": PROFILE,
+		"rules": len(COMPILED_RULES),
+		"sections": {name: ring.summary()
+			for name, ring in list(PROFILE_TIMINGS.items())},
+		"slowest_rules": rules[:top],
+		"condition_types": conditions}
+
+
+def dump_profile(path=None):
+	"""Write the profile report as json, returns the path written or None"""
+	if path is None:
+		path = get_config_path(PROFILE_DUMP)
+	if not path:
+		return None
+	with open(path, "w") as fd:
+		json.dump(get_profile_report(), fd, indent=2, sort_keys=True)
+	log("Wrote performance stats to "+path)
+	return path
 
 
 # -----------------------------------------------------------------------------
@@ -430,12 +2420,53 @@ def interpret_value(value):
 def register():
 	global STOP_SERVER
 	STOP_SERVER = False
+	WAKE_EVENT.clear()
+	if hasattr(bpy.app, "timers"):
+		bpy.app.timers.register(
+			snapshot_timer, first_interval=CHECK_INTERVAL, persistent=True)
+		bpy.app.timers.register(
+			pack_watch_timer, first_interval=PACK_POLL_INTERVAL, persistent=True)
+	for name, handler in SUSPEND_HANDLERS:
+		if hasattr(bpy.app.handlers, name):
+			getattr(bpy.app.handlers, name).append(handler)
 
 
 def unregister():
-	global STOP_SERVER
 	global SUGGESTIONS
-	global SUGGESTION_BANK
-	STOP_SERVER = True
+	global OPS_CURSOR
+	global SNAPSHOT
+	global SNAPSHOT_CHANGES
+	global SCENE_FACTS
+	global SCENE_FACTS_DIRTY
+	global SCENE_OBJECTS
+	global POPUP_READY
+	global PACKS
+	global PACK_SIGNATURES
+	global PACKS_CHANGED
+	global PACKS_RELOADED
+	stop_background_thread()
+	flush_dismissed_suggestions()
+	POPUP_READY = False
+	for name, handler in SUSPEND_HANDLERS:
+		handlers = getattr(bpy.app.handlers, name, [])
+		if handler in handlers:
+			handlers.remove(handler)
+	SUSPENDED.clear()
+	if hasattr(bpy.app, "timers"):
+		for timer in (snapshot_timer, header_blink_timer, pack_watch_timer):
+			if bpy.app.timers.is_registered(timer):
+				bpy.app.timers.unregister(timer)
+	SNAPSHOT = None
+	SNAPSHOT_CHANGES = None
+	SCENE_FACTS = {}
+	SCENE_FACTS_DIRTY = True
+	SCENE_OBJECTS = {}
+	NAME_INDEXES.clear()
 	SUGGESTIONS = {}
-	SUGGESTION_BANK = []
+	publish_rules([])
+	PACKS = {}
+	PACK_SIGNATURES = None
+	PACKS_CHANGED = False
+	PACKS_RELOADED = False
+	OPS_SEQUENCE.clear()
+	OPS_CURSOR = None
@@ -16,9 +16,9 @@
 #
 # ##### END GPL LICENSE BLOCK #####
 
+import functools
 import os
 import random
-import textwrap
 import time
 
 import bpy
@@ -39,69 +39,140 @@ from . import assistant_tools as tools
 
 SUGGESTION_FORM_URL = "https://forms.gle/5KPyzQynnXWVbKzC6"
 RANDOM_TICK = None  # used to display a random assistant icon
+POSE_NAMES = [] # sorted names of loaded assistant icons
+UI_FONT_POINTS = 11 # default blender UI font size used for measuring text
+DEFAULT_CHAR_WIDTH = 5.5 # estimated char width in pixels if font can't be measured
+CHAR_WIDTHS = {} # measured char widths per UI scale, see get_char_widths
+MOOD_ITEMS = {} # cached enum items per pose name, see get_suzanne_mood
+preview_collections = {} # loaded on first use, see get_poses
 
 
 @bpy.app.handlers.persistent
-def scene_update_handler(scene):
-	"""Runs when scene updates, to see whether to display a suggestion.
+def scene_update_handler(scene, depsgraph=None):
+	"""Runs when scene updates, to display a suggestion flagged as ready.
 
-	This will trigger constantly, be warned!
+	This would trigger constantly, so the engine only attaches it while a
+	popup is ready (see tools.sync_popup_handler) and it otherwise returns
+	after a single flag check.
 	"""
-	if tools.SUGGESTIONS == {}:
+	if tools.POPUP_READY is False:
 		return
-	if tools.get_addon_preferences().passive is True:
-		return
-	if tools.SUGGESTIONS["id"] in tools.DISMISSED:
-		return
-	if tools.PREVIOUS_POPUP == tools.SUGGESTIONS["id"]:
-		return # don't retrigger the same suggestion
-	if time.time() < tools.SCENE_POPUP_INTERVAL + tools.UI_LAST_CHECK:
-		return  # don't trigger a new popup yet
+	if tools.PROFILE:
+		start = tools.clock_ns()
+	tools.POPUP_READY = False
 	tools.UI_LAST_CHECK = time.time()
+	tools.reschedule_check() # elapsed deadlines moved with UI_LAST_CHECK
 	tools.log("Suggestion found, triggering popup")
 	bpy.ops.assist.suggestion_action('INVOKE_DEFAULT')
-	tools.PREVIOUS_POPUP = tools.SUGGESTIONS["id"]
+	tools.PREVIOUS_POPUP = tools.SUGGESTIONS.get("id")
+	if tools.PROFILE:
+		tools.record_timing("scene_update_handler", tools.clock_ns() - start)
 
 
-def word_wrap(element, text, width=400):
+def get_char_widths(scale):
+	"""Returns measured pixel width per character of the UI font at scale"""
+	widths = CHAR_WIDTHS.get(scale)
+	if widths is not None:
+		return widths
+	widths = {}
+	try:
+		import blf
+		size = int(round(UI_FONT_POINTS*scale))
+		try:
+			blf.size(0, size, 72)
+		except TypeError:
+			blf.size(0, size) # dpi argument removed in blender 4.0
+		for code in range(32, 127):
+			widths[chr(code)] = blf.dimensions(0, chr(code))[0]
+	except Exception as err:
+		tools.log("Could not measure font, using estimate: "+str(err))
+		widths = {}
+	CHAR_WIDTHS[scale] = widths
+	return widths
+
+
+@functools.lru_cache(maxsize=128)
+def wrap_lines(text, width, scale=1):
+	"""Wrap text into lines no wider than width pixels, cached per text/width"""
+	widths = get_char_widths(scale)
+	default = DEFAULT_CHAR_WIDTH*scale
+	space = widths.get(" ", default)
+	lines = []
+	for paragraph in text.split("\n"):
+		line = []
+		line_width = 0
+		for word in paragraph.split():
+			word_width = sum(widths.get(char, default) for char in word)
+			if line and line_width + space + word_width > width:
+				lines.append(" ".join(line))
+				line = []
+				line_width = 0
+			if line:
+				line_width += space
+			line.append(word)
+			line_width += word_width
+		lines.append(" ".join(line))
+	return tuple(lines)
+
+
+def word_wrap(element, text, width=400, scale=1):
 	"""Utility for wrapping text over multiple lines for UI drawing"""
-	# context.user_preferences.system.pixel_size
-	# width =
-	label_lines = text.split("\n")
-	for line in label_lines:
-		sub_lns = textwrap.fill(line, width/5.5) # /5 in place of actual kerning
-		spl = sub_lns.split("\n")
-		for sub_line in spl:
-			element.label(text=sub_line)
+	for sub_line in wrap_lines(text, width, scale):
+		element.label(text=sub_line)
+
+
+def get_poses():
+	"""Returns the assistant pose previews, loading them on first use.
+
+	Deferred from register so that enabling the addon at startup doesn't pay
+	for loading icons until a popup is actually shown.
+	"""
+	global POSE_NAMES
+	icns = preview_collections.get("assistant_poses")
+	if icns is not None:
+		return icns
+
+	start = time.time()
+	icns = bpy.utils.previews.new()
+	icns.folder = os.path.join(os.path.dirname(__file__), "icons")
+	pngs = [png for png in os.listdir(icns.folder)
+		if os.path.isfile(os.path.join(icns.folder, png))
+		and png.lower().endswith(".png")]
+	for png in pngs:
+		icns.load(png[:-4], os.path.join(icns.folder, png), 'IMAGE')
+	preview_collections["assistant_poses"] = icns
+	POSE_NAMES = sorted(icns.keys())
+	tools.log("Loaded assistant icons in {:.1f}ms: {}".format(
+		(time.time()-start)*1000, POSE_NAMES))
+	return icns
 
 
 def get_suzanne_mood(self, context):
-	"""Sets single item of UI List for icon display purpsoes"""
-	global RANDOM_TICK
+	"""Sets single item of UI List for icon display purpsoes
 
-	if tools.SUGGESTIONS and tools.SUGGESTIONS.get("icon") in preview_collections["assistant_poses"]:
-		use_set = tools.SUGGESTIONS.get("icon")
-	elif len(preview_collections["assistant_poses"]) <= RANDOM_TICK:
-		use_set = sorted(list(preview_collections["assistant_poses"]))[0]
-	else:
-		use_set = sorted(list(preview_collections["assistant_poses"]))[RANDOM_TICK]
-	thumbnails = []
+	Items are cached per pose, so redraws allocate nothing and blender keeps
+	stable references to the returned strings.
+	"""
+	poses = get_poses()
 	if not tools.SUGGESTIONS:
-		thumbnails.append((
-			"derp", # unused python access prop value
-			"derp", # Display name
-			"I'm here to help", # hover text
-			preview_collections["assistant_poses"]["derp"].icon_id, # icon!
-			0 # retain order
-		))
+		use_set = "derp"
+	elif tools.SUGGESTIONS.get("icon") in poses:
+		use_set = tools.SUGGESTIONS.get("icon")
+	elif len(POSE_NAMES) <= (RANDOM_TICK or 0):
+		use_set = POSE_NAMES[0]
 	else:
-		thumbnails.append((
+		use_set = POSE_NAMES[RANDOM_TICK or 0]
+
+	thumbnails = MOOD_ITEMS.get(use_set)
+	if thumbnails is None:
+		thumbnails = [(
 			use_set, # unused python access prop value
 			use_set, # Display name
 			"I'm here to help", # hover text
-			preview_collections["assistant_poses"][use_set].icon_id, # icon!
+			poses[use_set].icon_id, # icon!
 			0 # retain order
-		))
+		)]
+		MOOD_ITEMS[use_set] = thumbnails
 	return thumbnails
 
 
@@ -141,8 +212,7 @@ class ASSIST_OT_assistant_suggestion_action(bpy.types.Operator):
 		# update the random tick for selecting assistant icon (once per show)
 		global RANDOM_TICK
 
-		RANDOM_TICK = random.randint(
-			0, len(preview_collections["assistant_poses"]))
+		RANDOM_TICK = random.randint(0, len(get_poses()))
 
 		# decide if showing an OK box or fleeting popup
 		show_ok = True
@@ -155,7 +225,6 @@ class ASSIST_OT_assistant_suggestion_action(bpy.types.Operator):
 			return wm.invoke_popup(self, width=400*tools.ui_scale())
 
 	def draw(self, context):
-		assistant_icon = preview_collections["assistant_poses"]["default"]
 		row = self.layout.row()
 		prefs = tools.get_addon_preferences()
 
@@ -187,7 +256,8 @@ class ASSIST_OT_assistant_suggestion_action(bpy.types.Operator):
 				self.action = None
 			self.suggestion_id = self.suggestion_state["id"]
 
-		word_wrap(r_subcol, text, 400*tools.ui_scale()*0.7)
+		scale = tools.ui_scale()
+		word_wrap(r_subcol, text, 400*scale*0.7, scale)
 		if dismiss:
 			right.prop(self, "dismiss")
 
@@ -195,17 +265,17 @@ class ASSIST_OT_assistant_suggestion_action(bpy.types.Operator):
 		tools.log("RUNNING EXECUTE of the assistant")
 		tools.LAST_CHECK = time.time()
 		if self.dismiss is True and self.suggestion_id:
-			tools.save_dismissed_suggestion(self.suggestion_id)
+			tools.save_dismissed_suggestion(self.suggestion_id, disk=True)
 			tools.SUGGESTIONS = {}
 			return {'FINISHED'}
 		if not self.action:
 			if not self.suggestion_state.get("buttons"):
 				# register this popup since there's no OK/dismiss button
-				tools.PREVIOUS_SUGGESTION = self.suggestion_id
+				tools.set_previous_suggestion(self.suggestion_id)
 			tools.log("No actions currently being taken")
 			return {'FINISHED'}
 		if self.suggestion_id:
-			tools.PREVIOUS_SUGGESTION = self.suggestion_id
+			tools.set_previous_suggestion(self.suggestion_id)
 
 		# implement the different forms of actions here
 		actions = self.action.split(" ")
@@ -227,8 +297,8 @@ class ASSIST_OT_assistant_suggestion_action(bpy.types.Operator):
 				getattr(getattr(bpy.ops, atr[0]),atr[1])('INVOKE_DEFAULT')
 			elif act == "trigger_followup":
 				# special case to force popup to show up sooner
-				tools.LAST_CHECK -= 10
-				tools.UI_LAST_CHECK = tools.LAST_CHECK
+				tools.UI_LAST_CHECK = time.time() - 10
+				tools.request_check()
 			elif act.lower().startswith("prop:"):
 				# assign a property value
 				if "=" not in act:
@@ -242,11 +312,56 @@ class ASSIST_OT_assistant_suggestion_action(bpy.types.Operator):
 		return {'FINISHED'}
 
 
+class ASSIST_OT_reset_dismissed(bpy.types.Operator):
+	"""Show all dismissed suggestions again, clearing the saved dismissals"""
+	bl_idname = "assist.reset_dismissed"
+	bl_label = "Reset dismissed suggestions"
+
+	def execute(self, context):
+		tools.reset_dismissed_suggestions()
+		self.report({'INFO'}, "Dismissed suggestions will show again")
+		return {'FINISHED'}
+
+
+class ASSIST_OT_dump_profile(bpy.types.Operator):
+	"""Write recorded performance stats as JSON to the addon config folder"""
+	bl_idname = "assist.dump_profile"
+	bl_label = "Dump performance stats"
+
+	def execute(self, context):
+		try:
+			path = tools.dump_profile()
+		except (IOError, OSError) as err:
+			self.report({'ERROR'}, "Could not write stats: "+str(err))
+			return {'CANCELLED'}
+		if not path:
+			self.report({'ERROR'}, "No config folder to write stats to")
+			return {'CANCELLED'}
+		self.report({'INFO'}, "Wrote performance stats to "+path)
+		return {'FINISHED'}
+
+
 def update_verbose(self, context):
 	"""Used to update printout logging verbosity"""
 	tools.VERBOSE = self.verbose
 
 
+def update_packs_folder(self, context):
+	"""Used to load suggestion packs from the newly chosen folder"""
+	tools.set_packs_folder(tools.get_packs_folder(self))
+
+
+def update_view(self, context):
+	"""Used to switch to the suggestions shown for the helpful and category filters"""
+	tools.set_view(self.helpful, self.category.strip())
+	tools.request_check()
+
+
+def update_profile(self, context):
+	"""Used to start or stop recording performance stats"""
+	tools.set_profiling(self.profile)
+
+
 class SBA_preferences(bpy.types.AddonPreferences):
 	bl_idname = __package__
 
@@ -258,11 +373,32 @@ class SBA_preferences(bpy.types.AddonPreferences):
 	helpful = bpy.props.BoolProperty(
 		name = "Helpful suggestions only",
 		description = "If enabled, only realistic or actually useful suggestions are provided (ie the non April fools part of this addon)",
+		update = update_view,
 		default = False)
+	category = bpy.props.StringProperty(
+		name = "Category",
+		description = "Only provide suggestions of this category, from the category column of the suggestion files. Leave empty for all",
+		update = update_view,
+		default = "")
 	passive = bpy.props.BoolProperty(
 		name = "Be more passive",
 		description = "If enabled, do not force showing popups and only indicate when suggestions are available via a change of icon in the INFO header",
 		default = False)
+	ignore_actions = bpy.props.StringProperty(
+		name = "Ignore actions",
+		description = "Comma separated operators to additionally ignore when checking recently used operators, e.g. object.select_all",
+		default = "")
+	packs_folder = bpy.props.StringProperty(
+		name = "Suggestion packs",
+		description = "Folder of extra suggestion tsv files, merged by id and reloaded when edited. Leave empty to use the packs folder in the addon config folder",
+		subtype = 'DIR_PATH',
+		update = update_packs_folder,
+		default = "")
+	profile = bpy.props.BoolProperty(
+		name = "Record performance stats",
+		description = "Time checks, rules and handlers of the assistant, for debugging",
+		update = update_profile,
+		default = False)
 
 	def draw(self, context):
 		layout = self.layout
@@ -294,6 +430,43 @@ class SBA_preferences(bpy.types.AddonPreferences):
 		row = layout.row()
 		row.prop(self, "verbose", text="Show verbose logging details")
 		row.prop(self, "helpful", text="Show only 'helpful' suggestions")
+		layout.prop(self, "category")
+		layout.prop(self, "ignore_actions")
+		layout.prop(self, "packs_folder")
+		if tools.BANK_DIAGNOSTICS:
+			self.draw_diagnostics(layout.box(), tools.BANK_DIAGNOSTICS)
+		layout.operator("assist.reset_dismissed")
+
+		layout.prop(self, "profile")
+		if self.profile:
+			self.draw_profile(layout.box())
+
+	def draw_diagnostics(self, layout, diagnostics, limit=5):
+		"""Draw the first problems found in suggestion files while loading"""
+		col = layout.column()
+		col.scale_y = 0.8
+		col.label(text="Skipped {} invalid suggestion rows:".format(
+			len(diagnostics)), icon='ERROR')
+		for diagnostic in diagnostics[:limit]:
+			col.label(text=diagnostic)
+		if len(diagnostics) > limit:
+			col.label(text="...and {} more, see the console with verbose logging".format(
+				len(diagnostics) - limit))
+
+	def draw_profile(self, layout):
+		"""Draw latency and call rates of timed sections and slowest rules"""
+		report = tools.get_profile_report(top=3)
+		col = layout.column()
+		col.scale_y = 0.8
+		if not report["sections"]:
+			col.label(text="No timings recorded yet")
+		for name, stats in sorted(report["sections"].items()):
+			col.label(text="{}: p50 {:.3f}ms, p99 {:.3f}ms, {:.2f} calls/s".format(
+				name, stats["p50"], stats["p99"], stats["rate"]))
+		for rule in report["slowest_rules"]:
+			col.label(text="Rule {}: {:.1f}us mean over {} evaluations".format(
+				rule["id"], rule["mean_us"], rule["evaluations"]))
+		layout.operator("assist.dump_profile")
 
 
 # -----------------------------------------------------------------------------
@@ -302,22 +475,17 @@ class SBA_preferences(bpy.types.AddonPreferences):
 
 
 def header_draw(self, context):
-	if tools.SUGGESTIONS != {} and time.time()%1>0.5:
-		self.layout.operator(
-			"assist.suggestion_action",
-			icon='ERROR',
-			text='',
-			emboss=False
-		)
-	else:
-		self.layout.operator(
-			"assist.suggestion_action",
-			icon='MONKEY',
-			text='',
-			emboss=False
-		)
-	# trigger loading of background thread if not
-	tools.start_background_thread_if_none()
+	"""Draw the assistant button, reading only the precomputed header state"""
+	if tools.PROFILE:
+		start = tools.clock_ns()
+	self.layout.operator(
+		"assist.suggestion_action",
+		icon=tools.HEADER_STATE[0],
+		text='',
+		emboss=False
+	)
+	if tools.PROFILE:
+		tools.record_timing("header_draw", tools.clock_ns() - start)
 
 
 # -----------------------------------------------------------------------------
@@ -328,6 +496,8 @@ def header_draw(self, context):
 classes = (
 	SBA_preferences,
 	ASSIST_OT_assistant_suggestion_action,
+	ASSIST_OT_reset_dismissed,
+	ASSIST_OT_dump_profile,
 )
 
 
@@ -341,49 +511,34 @@ def register():
 	if hasattr(bpy.types, "TOPBAR_MT_editor_menus"):
 		bpy.types.TOPBAR_MT_editor_menus.append(header_draw)
 
-	# setup icons
-	global preview_collections
-	preview_collections = {}
-	icns = bpy.utils.previews.new()
-	icns.folder = os.path.join(os.path.dirname(__file__), "icons")
-	pngs = [png for png in os.listdir(icns.folder)
-		if os.path.isfile(os.path.join(icns.folder, png))
-		and png.lower().endswith(".png")]
-
-	tools.log("Detected assistant icons: " +str(pngs))
-	for png in pngs:
-		icns.load(png[:-4], os.path.join(icns.folder, png), 'IMAGE')
-	preview_collections["assistant_poses"] = icns
-
-	# setup scene handler to trigger popups
-	if bpy.app.version < (2, 80):
-		bpy.app.handlers.scene_update_post.append(scene_update_handler)
-	else:
-		if hasattr(bpy.app.handlers, "depsgraph_update_post"):
-			bpy.app.handlers.depsgraph_update_post.append(scene_update_handler)
+	# setup scene handlers to keep scene facts current, and checks if no app
+	# timers, the popup handler is only attached by tools when a popup is ready
+	tools.POPUP_HANDLER = scene_update_handler
+	handlers = tools.get_update_handlers()
+	handlers.append(tools.scene_facts_handler)
+	if not hasattr(bpy.app, "timers"):
+		handlers.append(tools.legacy_update_handler)
 
 
 def unregister():
 	"""Clean up everything"""
-	try:
-		if bpy.app.version < (2, 80):
-			bpy.app.handlers.scene_update_post.remove(scene_update_handler)
-		else:
-			if hasattr(bpy.app.handlers, "depsgraph_update_post"):
-				bpy.app.handlers.depsgraph_update_post.remove(scene_update_handler)
-	except:
-		log("Issue trying to remove scene/depsgraph handlers on disable")
-		pass
+	handlers = tools.get_update_handlers()
+	for handler in (scene_update_handler, tools.scene_facts_handler,
+			tools.legacy_update_handler):
+		if handler in handlers:
+			handlers.remove(handler)
+	tools.POPUP_HANDLER = None
 
 	bpy.types.INFO_HT_header.remove(header_draw)
 	if hasattr(bpy.types, "TOPBAR_MT_editor_menus"):
 		bpy.types.TOPBAR_MT_editor_menus.remove(header_draw)
 
-	# remove icons
-	if use_icons and preview_collections["assistant_poses"]:
+	# remove icons, if any popup loaded them
+	if use_icons and preview_collections:
 		for pcoll in preview_collections.values():
 			bpy.utils.previews.remove(pcoll)
 		preview_collections.clear()
+	MOOD_ITEMS.clear()
 
 	for cls in reversed(classes):
 		bpy.utils.unregister_class(cls)
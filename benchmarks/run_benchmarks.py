@@ -0,0 +1,411 @@
+#!/usr/bin/env python3
+###
+# DO NOT DISTRIBUTE WITH ADDON
+# Headless benchmarks of the suggestion rule engine, using the fake bpy module
+# in stubs/ so no blender install is needed.
+###
+
+"""Benchmark load_suggestions, update_ops_sequence and generate_suggestions.
+
+Run with python 3.7+ from any working directory:
+
+	python3 benchmarks/run_benchmarks.py [--quick] [--output results.json]
+
+Synthetic suggestion banks, scenes and operator histories are generated from
+a fixed seed. Results are printed as json, with per benchmark median latency
+and traced allocations plus scaling curves, and are compared to baselines.json
+next to this script. The run exits non-zero if any benchmark regressed beyond
+the tolerance. Timings depend on the machine, so refresh the baseline with
+--update-baseline (with and without --quick) on the machine used for
+comparisons.
+"""
+
+import argparse
+import gc
+import json
+import os
+import platform
+import random
+import shutil
+import statistics
+import sys
+import tempfile
+import time
+import tracemalloc
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(BENCH_DIR, "stubs"))
+sys.path.insert(1, os.path.dirname(BENCH_DIR))
+
+import bpy
+import assistant_tools as tools
+
+
+# Global vars, the things to change
+BASELINE = os.path.join(BENCH_DIR, "baselines.json")
+BANK_SIZES = (10, 100, 1000, 10000, 50000)
+SCENE_SIZES = (0, 1000, 100000, 500000)
+HISTORY_SIZES = (10, 1000, 100000)
+QUICK_BANK_SIZES = (10, 1000, 10000) # subset run with --quick
+QUICK_SCENE_SIZES = (0, 1000, 100000)
+QUICK_HISTORY_SIZES = (10, 1000, 100000)
+DEFAULT_BANK = 1000 # bank size while sweeping scene and history sizes
+DEFAULT_SCENE = 1000 # scene size while sweeping bank sizes
+DEFAULT_HISTORY = 100 # operators in history while benchmarking cycles
+PACK_RULES = 10 # rules in the pack edited on top of a bank
+REPEATS = 5 # timed runs per benchmark, the median is reported
+TOLERANCE = 2.0 # allowed factor over the baseline before failing, timings are noisy
+MIN_REGRESSION_MS = 0.2 # ignore slowdowns below this, timer noise
+MIN_REGRESSION_KB = 16 # ignore allocation growth below this
+SEED = 1
+BANK_HEADER = "id\tcondition\ticon\tsuggestion\tbuttons\taction\thelpful\tpriority\r\n"
+
+# prop paths used by synthetic rules with plausible values, written as in a
+# tsv so strings are quoted, includes paths missing in the fake context and an
+# unset active object like in blender
+PROP_VALUES = {
+	"scene.render.use_multiview": ("True", "False"),
+	"scene.render.views_format": ("'STEREO_3D'", "'MULTIVIEW'"),
+	"scene.render.engine": ("'CYCLES'", "'BLENDER_EEVEE'"),
+	"scene.render.resolution_x": ("1920", "3840"),
+	"scene.frame_end": ("250", "100"),
+	"scene.cycles.samples": ("128",),
+	"object.name": ("'Cube'",)
+}
+OBJECT_TYPES = ("MESH", "MESH", "MESH", "EMPTY", "LIGHT", "CAMERA")
+OPERATORS = ("MESH_OT_primitive_cube_add", "MESH_OT_primitive_torus_add",
+	"OBJECT_OT_delete", "OBJECT_OT_select_all", "TRANSFORM_OT_translate",
+	"OBJECT_OT_modifier_add", "MATERIAL_OT_new", "OBJECT_OT_shade_smooth")
+OPS_NAMES = ("mesh.primitive_cube_add", "mesh.primitive_torus_add",
+	"object.delete", "object.modifier_add", "material.new",
+	"object.shade_smooth")
+
+
+# -----------------------------------------------------------------------------
+# Synthetic data
+# -----------------------------------------------------------------------------
+
+
+def random_condition(rng, index):
+	"""Returns one random condition, of any type the bank grammar supports"""
+	kind = rng.randrange(12)
+	if kind == 0:
+		return "prev:rule_{}".format(rng.randrange(max(index, 1)))
+	elif kind == 1:
+		return "no_prev"
+	elif kind == 2:
+		return "elapsed:{}s".format(rng.choice((10, 30, 60, 120, 300)))
+	elif kind == 3:
+		return "ops_last:"+rng.choice(OPS_NAMES)
+	elif kind == 4:
+		return "ops_recent:"+rng.choice(OPS_NAMES)
+	elif kind == 5:
+		return "ops_seq:{}>{}".format(rng.choice(OPS_NAMES), rng.choice(OPS_NAMES))
+	elif kind in (6, 7):
+		path = rng.choice(sorted(PROP_VALUES))
+		return "prop:{}={}".format(path, rng.choice(PROP_VALUES[path]))
+	elif kind == 8:
+		return "object_exists:Cube.{:06d}".format(rng.randrange(1000))
+	elif kind == 9:
+		return rng.choice(("no_object_exists:Torus*", "material_exists:Mat*",
+			"no_collection_exists:Props"))
+	return rng.choice(("is_void", "no_camera"))
+
+
+def write_bank(folder, rules):
+	"""Write a synthetic suggestion bank with the number of rules, returns path"""
+	rng = random.Random(SEED)
+	path = os.path.join(folder, "bank_{}.tsv".format(rules))
+	with open(path, "w", newline="") as fd:
+		fd.write(BANK_HEADER)
+		for i in range(rules):
+			conditions = " ".join(random_condition(rng, i)
+				for _ in range(rng.randint(1, 3)))
+			fd.write("rule_{}\t{}\thelpful\tSuggestion number {}\tok,dismiss\tnone\t{}\t{}\r\n".format(
+				i, conditions, i, rng.choice(("TRUE", "FALSE")), rng.choice(("", "0", "1", "2"))))
+	return path
+
+
+def write_pack(path, version):
+	"""Write a small pack replacing the first rules of a bank, as if edited"""
+	with open(path, "w", newline="") as fd:
+		fd.write(BANK_HEADER)
+		for i in range(PACK_RULES):
+			fd.write("rule_{}\tno_prev elapsed:{}s\thelpful\tEdit {} of rule {}\tok\tnone\tTRUE\t1\r\n".format(
+				i, 10+i, version, i))
+	os.utime(path, ns=(version*1000, version*1000)) # distinct mtime per edit
+
+
+def set_scene(objects):
+	"""Fill the fake scene with the number of objects of mixed types"""
+	bpy.set_objects(("Cube.{:06d}".format(i), OBJECT_TYPES[i % len(OBJECT_TYPES)])
+		for i in range(objects))
+	tools.mark_scene_facts_dirty()
+
+
+def set_history(operators):
+	"""Replace the operator history with the number of random operators"""
+	rng = random.Random(SEED)
+	bpy.context.window_manager.operators = []
+	bpy.add_operators(rng.choice(OPERATORS) for _ in range(operators))
+	tools.OPS_CURSOR = None
+	tools.OPS_SEQUENCE.clear()
+
+
+def forget_bank():
+	"""Drop the loaded bank, so the next load starts from scratch"""
+	tools.PACKS = {}
+	tools.PACK_SIGNATURES = None
+	tools.COMPILED_RULES = []
+
+
+def load_bank(path):
+	"""Load a bank and reset all engine state, as after registering"""
+	forget_bank()
+	tools.load_suggestions([path])
+	tools.PREVIOUS_SUGGESTION = None
+	tools.UI_LAST_CHECK = time.time()
+	tools.DISMISSED.clear()
+	tools.DISMISSED_VERSION += 1
+	tools.NAME_INDEXES.clear()
+	tools.mark_scene_facts_dirty()
+
+
+# -----------------------------------------------------------------------------
+# Measurement
+# -----------------------------------------------------------------------------
+
+
+def measure(func, setup=None, repeats=REPEATS):
+	"""Time func over repeated runs, then trace the allocations of one more.
+
+	Setup runs before each call and is not timed. Garbage collection is off
+	during calls like with timeit, as its timing depends on everything else
+	allocated so far. Peak is the most memory allocated at once during the
+	call, retained what is still held after.
+	"""
+	times = []
+	for _ in range(repeats):
+		if setup:
+			setup()
+		gc.collect()
+		gc.disable()
+		start = time.perf_counter_ns()
+		func()
+		times.append(time.perf_counter_ns() - start)
+		gc.enable()
+	if setup:
+		setup()
+	gc.collect()
+	gc.disable()
+	tracemalloc.start()
+	func()
+	retained, peak = tracemalloc.get_traced_memory()
+	tracemalloc.stop()
+	gc.enable()
+	return {
+		"median_ms": statistics.median(times) / 1e6,
+		"max_ms": max(times) / 1e6,
+		"peak_kb": peak / 1024,
+		"retained_kb": retained / 1024}
+
+
+def run_cycle():
+	"""One check, capturing a snapshot then evaluating the rules against it"""
+	tools.refresh_scene_facts(bpy.context)
+	tools.capture_snapshot()
+	tools.generate_suggestions(*tools.take_snapshot())
+
+
+def bench_load(folder, sizes, results):
+	"""Load banks from tsv, from the compiled cache and after editing a pack"""
+	cache = tools.get_config_path(tools.BANK_CACHE)
+	pack = os.path.join(folder, "pack.tsv")
+	edits = [0]
+
+	def clear_cache():
+		forget_bank()
+		if os.path.isdir(cache):
+			shutil.rmtree(cache)
+
+	def edit_pack():
+		edits[0] += 1
+		write_pack(pack, edits[0])
+
+	for rules in sizes:
+		path = write_bank(folder, rules)
+		results["load_suggestions/tsv/rules={}".format(rules)] = measure(
+			lambda: tools.load_suggestions([path]), setup=clear_cache)
+		results["load_suggestions/cache/rules={}".format(rules)] = measure(
+			lambda: tools.load_suggestions([path]), setup=forget_bank)
+		write_pack(pack, edits[0])
+		load_bank(path)
+		tools.load_suggestions([path, pack])
+		results["load_suggestions/edit_pack/rules={}".format(rules)] = measure(
+			lambda: tools.load_suggestions([path, pack]), setup=edit_pack)
+
+
+def bench_ops(folder, sizes, results):
+	"""Capture operators from histories of increasing length"""
+	load_bank(write_bank(folder, DEFAULT_BANK))
+	rng = random.Random(SEED)
+
+	def forget_cursor():
+		tools.OPS_CURSOR = None
+
+	def run_operators():
+		bpy.add_operators(rng.choice(OPERATORS) for _ in range(5))
+
+	for operators in sizes:
+		set_history(operators)
+		results["update_ops_sequence/first/history={}".format(operators)] = measure(
+			tools.update_ops_sequence, setup=forget_cursor)
+		results["update_ops_sequence/new5/history={}".format(operators)] = measure(
+			tools.update_ops_sequence, setup=run_operators)
+		results["update_ops_sequence/idle/history={}".format(operators)] = measure(
+			tools.update_ops_sequence)
+
+
+def bench_cycles(path, objects, param, results):
+	"""Checks after a full reload, when idle, on new previous and on scene edits.
+
+	Scene edits are timed both as a full rescan, as after removing objects,
+	and as an object added and reported through a depsgraph update. Last,
+	idle checks once every matching suggestion got dismissed, so no rule
+	matches and nothing stops the search for a candidate early.
+	"""
+	load_bank(path)
+	set_history(DEFAULT_HISTORY)
+	set_scene(objects)
+	run_cycle()
+	rng = random.Random(SEED)
+	rules = len(tools.COMPILED_RULES)
+
+	def pend_all():
+		tools.mark_pending(range(rules))
+
+	def change_prev():
+		tools.PREVIOUS_SUGGESTION = "rule_{}".format(rng.randrange(rules))
+
+	def add_object():
+		ob = bpy.add_object("Added.{:06d}".format(len(bpy.data.objects)), "MESH")
+		tools.scene_facts_handler(bpy.context.scene, bpy.depsgraph_update([ob]))
+
+	for name, setup in (("full", pend_all), ("idle", None),
+			("prev", change_prev), ("scene", tools.mark_scene_facts_dirty),
+			("add", add_object)):
+		results["cycle/{}/{}".format(name, param)] = measure(run_cycle, setup=setup)
+
+	tools.PREVIOUS_SUGGESTION = None
+	run_cycle()
+	while tools.SUGGESTIONS:
+		tools.save_dismissed_suggestion(tools.SUGGESTIONS["id"])
+		tools.generate_suggestions(*tools.take_snapshot())
+	results["cycle/nomatch/{}".format(param)] = measure(run_cycle)
+
+
+def bench_generate(folder, bank_sizes, scene_sizes, results):
+	"""Cycles sweeping bank sizes at a fixed scene, and scene sizes at a fixed bank"""
+	for rules in bank_sizes:
+		bench_cycles(write_bank(folder, rules), DEFAULT_SCENE,
+			"rules={}".format(rules), results)
+	path = write_bank(folder, DEFAULT_BANK)
+	for objects in scene_sizes:
+		bench_cycles(path, objects, "objects={}".format(objects), results)
+	set_scene(0)
+
+
+# -----------------------------------------------------------------------------
+# Reporting
+# -----------------------------------------------------------------------------
+
+
+def scaling_curves(results):
+	"""Group results by benchmark into [size, median ms, peak kb] curves"""
+	curves = {}
+	for name, result in results.items():
+		bench, _, param = name.rpartition("/")
+		key, _, size = param.partition("=")
+		curves.setdefault("{}/{}".format(bench, key), []).append(
+			[int(size), result["median_ms"], result["peak_kb"]])
+	for curve in curves.values():
+		curve.sort()
+	return curves
+
+
+def compare(results, baseline, tolerance):
+	"""Returns descriptions of results regressed against the baseline"""
+	regressions = []
+	for name, base in sorted(baseline.get("results", {}).items()):
+		result = results.get(name)
+		if result is None:
+			continue
+		if result["median_ms"] > base["median_ms"]*tolerance + MIN_REGRESSION_MS:
+			regressions.append("{}: {:.3f}ms, baseline {:.3f}ms".format(
+				name, result["median_ms"], base["median_ms"]))
+		if result["peak_kb"] > base["peak_kb"]*tolerance + MIN_REGRESSION_KB:
+			regressions.append("{}: peak {:.1f}kb, baseline {:.1f}kb".format(
+				name, result["peak_kb"], base["peak_kb"]))
+	return regressions
+
+
+def main():
+	parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+	parser.add_argument("--quick", action="store_true",
+		help="only run the smaller sizes, for fast regression checks")
+	parser.add_argument("--output", help="also write the json report to this file")
+	parser.add_argument("--baseline", default=BASELINE,
+		help="baseline json to compare against")
+	parser.add_argument("--update-baseline", action="store_true",
+		help="store these results as the baseline instead of comparing")
+	parser.add_argument("--tolerance", type=float, default=TOLERANCE,
+		help="allowed factor over baseline latency and allocations")
+	args = parser.parse_args()
+
+	results = {}
+	with tempfile.TemporaryDirectory(prefix="suzanne_bench_") as folder:
+		bpy.CONFIG_DIR = folder # keep the compiled bank cache out of real configs
+		if args.quick:
+			bench_load(folder, QUICK_BANK_SIZES, results)
+			bench_ops(folder, QUICK_HISTORY_SIZES, results)
+			bench_generate(folder, QUICK_BANK_SIZES, QUICK_SCENE_SIZES, results)
+		else:
+			bench_load(folder, BANK_SIZES, results)
+			bench_ops(folder, HISTORY_SIZES, results)
+			bench_generate(folder, BANK_SIZES, SCENE_SIZES, results)
+
+	report = {
+		"python": platform.python_version(),
+		"platform": platform.platform(),
+		"quick": args.quick,
+		"results": results,
+		"curves": scaling_curves(results)}
+
+	# quick and full runs are kept apart, as earlier benchmarks in a run
+	# affect the memory layout and so the timings of later ones
+	mode = "quick" if args.quick else "full"
+	baselines = {}
+	if os.path.isfile(args.baseline):
+		with open(args.baseline) as fd:
+			baselines = json.load(fd)
+	if args.update_baseline:
+		baselines[mode] = {"results": results}
+		with open(args.baseline, "w") as fd:
+			json.dump(baselines, fd, indent=1, sort_keys=True)
+			fd.write("\n")
+	elif mode in baselines:
+		report["regressions"] = compare(results, baselines[mode], args.tolerance)
+
+	text = json.dumps(report, indent=1, sort_keys=True)
+	print(text)
+	if args.output:
+		with open(args.output, "w") as fd:
+			fd.write(text+"\n")
+	if report.get("regressions"):
+		print("Regressed against baseline:\n  "+"\n  ".join(report["regressions"]),
+			file=sys.stderr)
+		sys.exit(1)
+
+
+if __name__ == "__main__":
+	main()
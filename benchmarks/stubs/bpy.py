@@ -0,0 +1,171 @@
+###
+# DO NOT DISTRIBUTE WITH ADDON
+# Minimal stand-in for the blender python module, only providing what the
+# rule engine in assistant_tools reads, so it can be benchmarked headless.
+###
+
+"""Fake bpy module for running assistant_tools outside of blender.
+
+Populate the scene with set_objects and the operator history with add_operators,
+then use the engine as usual. Objects added with add_object are reported to
+depsgraph handlers through the updates of depsgraph_update.
+"""
+
+import os
+import tempfile
+
+
+class Namespace(object):
+	"""Plain attribute container standing in for blender structs"""
+
+	def __init__(self, **kwargs):
+		self.__dict__.update(kwargs)
+
+
+class IDCollection(object):
+	"""Named datablock collection like bpy.data.objects, indexable by name"""
+
+	def __init__(self, items=()):
+		self.items = list(items)
+		self.by_name = {item.name: item for item in self.items}
+
+	def __iter__(self):
+		return iter(self.items)
+
+	def __len__(self):
+		return len(self.items)
+
+	def __getitem__(self, key):
+		if isinstance(key, str):
+			return self.by_name[key]
+		return self.items[key]
+
+	def __contains__(self, name):
+		return name in self.by_name
+
+	def keys(self):
+		return self.by_name.keys()
+
+	def get(self, name, default=None):
+		return self.by_name.get(name, default)
+
+	def link(self, item):
+		self.items.append(item)
+		self.by_name[item.name] = item
+
+
+class ID(object):
+	"""Datablock with a name and a unique pointer"""
+	__slots__ = ("name", "pointer")
+	next_pointer = 1
+
+	def __init__(self, name):
+		self.name = name
+		self.pointer = ID.next_pointer
+		ID.next_pointer += 1
+
+	def as_pointer(self):
+		return self.pointer
+
+
+class Collection(ID):
+	pass
+
+
+class Material(ID):
+	pass
+
+
+class Scene(Namespace):
+	pass
+
+
+class Object(ID):
+	"""Datablock with just a name and type, as read for scene facts"""
+	__slots__ = ("type",)
+
+	def __init__(self, name, type):
+		ID.__init__(self, name)
+		self.type = type
+
+
+class Operator(object):
+	"""Registered operator in the window manager history"""
+	__slots__ = ("bl_idname", "pointer")
+	next_pointer = 1
+
+	def __init__(self, bl_idname):
+		self.bl_idname = bl_idname
+		self.pointer = Operator.next_pointer
+		Operator.next_pointer += 1
+
+	def as_pointer(self):
+		return self.pointer
+
+
+def persistent(func):
+	return func
+
+
+CONFIG_DIR = os.path.join(tempfile.gettempdir(), "blender_stub_config") # user config
+
+
+def user_resource(resource_type, path="", create=False):
+	folder = os.path.join(CONFIG_DIR, path)
+	if create and not os.path.isdir(folder):
+		os.makedirs(folder)
+	return folder
+
+
+app = Namespace(
+	version=(2, 80, 0),
+	handlers=Namespace(depsgraph_update_post=[], persistent=persistent))
+types = Namespace(Object=Object, Collection=Collection, Material=Material,
+	Scene=Scene, Operator=object, AddonPreferences=object)
+utils = Namespace(user_resource=user_resource)
+data = Namespace(
+	objects=IDCollection(),
+	collections=IDCollection([Collection("Collection")]),
+	materials=IDCollection([Material("Material")]))
+context = Namespace(
+	scene=Scene(
+		name="Scene",
+		objects=data.objects,
+		frame_start=1,
+		frame_end=250,
+		render=Namespace(
+			engine="BLENDER_EEVEE",
+			resolution_x=1920,
+			resolution_y=1080,
+			use_multiview=False,
+			views_format="STEREO_3D")),
+	object=None,
+	preferences=Namespace(addons={}),
+	window_manager=Namespace(operators=[], windows=[]))
+
+
+def set_objects(objects):
+	"""Replace all scene objects with the given (name, type) pairs"""
+	data.objects = IDCollection(Object(name, ob_type) for name, ob_type in objects)
+	context.scene.objects = data.objects
+
+
+def add_object(name, type):
+	"""Add an object to the scene, returns it for use with depsgraph_update"""
+	ob = Object(name, type)
+	data.objects.link(ob)
+	return ob
+
+
+def depsgraph_update(datablocks, transform=False):
+	"""Returns a depsgraph as passed to handlers, with updates of the datablocks"""
+	return Namespace(scene=context.scene, updates=[Namespace(
+		id=datablock,
+		is_updated_transform=transform,
+		is_updated_geometry=False,
+		is_updated_shading=False) for datablock in datablocks])
+
+
+def add_operators(idnames):
+	"""Append operators to the window manager history, as if just ran"""
+	context.window_manager.operators.extend(Operator(idname) for idname in idnames)